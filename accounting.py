@@ -0,0 +1,99 @@
+import json
+import time
+from pathlib import Path
+from typing import Optional
+
+from data_loading import Sample
+
+# US dollars per million input and output tokens, where output includes reasoning tokens.
+# Dated engine versions, such as gpt-4o-2024-08-06, are priced by their longest matching prefix.
+PRICES = {
+    "o1": (15.0, 60.0),
+    "o1-preview": (15.0, 60.0),
+    "o1-mini": (1.1, 4.4),
+    "gpt-4o": (2.5, 10.0),
+    "gpt-4o-mini": (0.15, 0.6),
+    "gpt-3.5-turbo": (0.5, 1.5),
+    "gemini-2.0-flash-exp": (0.0, 0.0),
+    "gemini-2.0-flash-thinking-exp": (0.0, 0.0),
+}
+# Requests sent through OpenAI's Batch API are billed at half the price
+BATCH_API_DISCOUNT = 0.5
+
+
+def get_cost(
+    engine: str,
+    prompt_tokens: int,
+    completion_tokens: int,
+    input_price: Optional[float] = None,
+    output_price: Optional[float] = None,
+) -> float:
+    """
+    Estimate the cost of a request in US dollars, using the given prices per million tokens over the listed ones.
+    Unlisted engines without given prices cost 0.
+    """
+    name = max((name for name in PRICES if engine.startswith(name)), key=len, default=None)
+    listed_input, listed_output = PRICES.get(name, (0.0, 0.0))
+    input_price = listed_input if input_price is None else input_price
+    output_price = listed_output if output_price is None else output_price
+    return (prompt_tokens * input_price + completion_tokens * output_price) / 1e6
+
+
+def get_percentile(values: list, percentile: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[int(percentile * (len(values) - 1))]
+
+
+class RunSummary:
+    """
+    Totals the usage, retries and cost of the samples finished in a run, and their latency percentiles.
+    Only latencies are kept per sample, so streamed runs stay flat in memory.
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.latencies = []
+        self.errors = 0
+        self.retries = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.reasoning_tokens = 0
+        self.cost = 0.0
+
+    def add(self, sample: Sample):
+        self.latencies.append(sample.latency)
+        self.errors += bool(sample.error)
+        self.retries += sample.retries
+        self.prompt_tokens += sample.prompt_tokens
+        self.completion_tokens += sample.completion_tokens
+        self.reasoning_tokens += sample.reasoning_tokens
+        self.cost += sample.cost
+
+    def summary(self) -> dict:
+        duration = time.time() - self.start
+        rate = lambda amount: amount / duration if duration > 0 else 0.0
+        return dict(
+            samples=len(self.latencies),
+            errors=self.errors,
+            retries=self.retries,
+            duration=duration,
+            samples_per_second=rate(len(self.latencies)),
+            tokens_per_second=rate(self.prompt_tokens + self.completion_tokens),
+            completion_tokens_per_second=rate(self.completion_tokens),
+            latency_p50=get_percentile(self.latencies, 0.5),
+            latency_p95=get_percentile(self.latencies, 0.95),
+            latency_p99=get_percentile(self.latencies, 0.99),
+            prompt_tokens=self.prompt_tokens,
+            completion_tokens=self.completion_tokens,
+            reasoning_tokens=self.reasoning_tokens,
+            cost=self.cost,
+        )
+
+    def save(self, path: str) -> dict:
+        info = self.summary()
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(info, f, indent=2)
+        return info
@@ -0,0 +1,68 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+
+class ResponseCache:
+    """
+    Content-addressed store of model outputs in a SQLite file, keyed by a hash of the model config and prompt.
+    Entries older than max_age seconds are dropped, and the least recently used entries are dropped once
+    the stored outputs exceed max_size bytes (0 disables either limit). Safe to share across threads and processes.
+    """
+
+    def __init__(self, path: str, max_age: float = 0.0, max_size: int = 0, evict_every: int = 100):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.max_age = max_age
+        self.max_size = max_size
+        self.evict_every = evict_every
+        self.puts = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, output TEXT, size INTEGER, created REAL, accessed REAL)"
+            )
+        self.evict()
+
+    @staticmethod
+    def make_key(config: dict, prompt: str) -> str:
+        return hashlib.sha256(json.dumps([config, prompt], sort_keys=True).encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self.lock, self.connection:
+            row = self.connection.execute("SELECT output, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or (self.max_age and time.time() - row[1] > self.max_age):
+                return None
+            self.connection.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+        return row[0]
+
+    def put(self, key: str, output: str):
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (key, output, len(output.encode()), now, now),
+            )
+            self.puts += 1
+            should_evict = self.puts % self.evict_every == 0
+        if should_evict:
+            self.evict()
+
+    def evict(self):
+        with self.lock, self.connection:
+            if self.max_age:
+                self.connection.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.max_age,))
+            if self.max_size:
+                total = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+                rows = self.connection.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall()
+                for key, size in rows:
+                    if total <= self.max_size:
+                        break
+                    self.connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    total -= size
@@ -1,7 +1,14 @@
+import gzip
+import hashlib
+import io
 import json
+import os
 import random
+import time
+import uuid
+from glob import glob
 from pathlib import Path
-from typing import List
+from typing import Dict, Iterable, Iterator, List, Tuple
 
 from fire import Fire
 from pydantic import BaseModel
@@ -12,6 +19,116 @@ class Sample(BaseModel):
     prompt: str = ""
     raw_output: str = ""
     pred: str = ""
+    latency: float = 0.0
+    error: str = ""
+    # Time to first token and output tokens per second of streamed requests
+    ttft: float = 0.0
+    tokens_per_second: float = 0.0
+    # Usage reported by the API, where completion_tokens include reasoning_tokens, and the estimated cost in US dollars
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    reasoning_tokens: int = 0
+    retries: int = 0
+    cost: float = 0.0
+    # With several completions per prompt, raw_output and pred hold the majority answer
+    raw_outputs: List[str] = []
+    preds: List[str] = []
+
+    def fingerprint(self) -> str:
+        return hashlib.sha256(json.dumps(self.inputs, sort_keys=True).encode()).hexdigest()
+
+    def in_shard(self, num_shards: int, shard_id: int) -> bool:
+        # Partition by input hash so every process agrees on the split regardless of file order
+        return int(self.fingerprint(), 16) % num_shards == shard_id
+
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+def open_file(path: str, mode: str = "r"):
+    """
+    Open a jsonl file in text mode, (de)compressing gzip or zstd transparently.
+    Reads detect the compression from the file header, writes from the .gz/.zst suffix.
+    """
+    if mode == "r":
+        with open(path, "rb") as f:
+            header = f.read(4)
+        is_gzip, is_zstd = header.startswith(GZIP_MAGIC), header.startswith(ZSTD_MAGIC)
+    else:
+        is_gzip, is_zstd = path.endswith(".gz"), path.endswith(".zst")
+
+    if is_gzip:
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    if is_zstd:
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("Reading or writing .zst files requires `pip install zstandard`")
+        raw = open(path, mode + "b")
+        if mode == "r":
+            stream = zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True, closefd=True)
+        else:
+            stream = zstandard.ZstdCompressor().stream_writer(raw, closefd=True)
+        return io.TextIOWrapper(stream, encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+class ResultWriter:
+    """
+    Append finished samples as jsonl lines in dataset order, even when they finish out of order.
+    The file is flushed and fsynced every sync_interval seconds, and always on close.
+    """
+
+    def __init__(self, path: str, sync_interval: float = 1.0, append: bool = False):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.file = open_file(path, "a" if append else "w")
+        self.sync_interval = sync_interval
+        self.last_sync = time.time()
+        self.pending: Dict[int, Sample] = {}
+        self.next_index = 0
+
+    def write(self, index: int, sample: Sample):
+        self.pending[index] = sample
+        while self.next_index in self.pending:
+            print(self.pending.pop(self.next_index).model_dump_json(), file=self.file)
+            self.next_index += 1
+        if time.time() - self.last_sync >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.last_sync = time.time()
+
+    def close(self):
+        # Samples still waiting on an earlier one (e.g. after an interrupted run) are kept, not dropped
+        for index in sorted(self.pending):
+            print(self.pending.pop(index).model_dump_json(), file=self.file)
+        self.sync()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def iter_samples(path: str) -> Iterator[Sample]:
+    with open_file(path) as f:
+        for line in f:
+            yield Sample(**json.loads(line))
+
+
+def save_samples(samples: Iterable[Sample], path: str):
+    # Write next to the target and swap it in, so an interrupted save never leaves a torn file
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    temp_path = str(Path(path).with_name(f".{uuid.uuid4().hex[:8]}.{Path(path).name}"))
+    with open_file(temp_path, "w") as f:
+        for sample in samples:
+            print(sample.model_dump_json(), file=f)
+    os.replace(temp_path, path)
 
 
 class Data(BaseModel):
@@ -19,15 +136,15 @@ class Data(BaseModel):
 
     @classmethod
     def load(cls, path: str):
-        with open(path, "r") as f:
-            samples = [Sample(**json.loads(line)) for line in f]
-        return cls(samples=samples)
+        return cls(samples=list(iter_samples(path)))
 
     def save(self, path: str):
-        Path(path).parent.mkdir(parents=True, exist_ok=True)
-        with open(path, "w") as f:
-            for sample in self.samples:
-                print(sample.json(), file=f)
+        save_samples(self.samples, path)
+
+    def shard(self, num_shards: int, shard_id: int):
+        if not 0 <= shard_id < num_shards:
+            raise ValueError(f"shard_id must be in [0, {num_shards}), got {shard_id}")
+        return Data(samples=[s for s in self.samples if s.in_shard(num_shards, shard_id)])
 
     def analyze(self, seed: int = 0):
         random.seed(seed)
@@ -40,27 +157,65 @@ class Data(BaseModel):
         print(json.dumps(info, indent=2))
 
 
-def select_data(name: str, **kwargs):
+def iter_completed(path: str) -> Iterator[Sample]:
+    """
+    Yield the samples of an existing output file that already have a raw_output.
+    A line torn by a crash ends the file instead of failing the load.
+    """
+    if not Path(path).exists():
+        return
+    try:
+        for sample in iter_samples(path):
+            if sample.raw_output:
+                yield sample
+    except (json.JSONDecodeError, EOFError):
+        pass
+
+
+def load_completed(path: str) -> Dict[str, List[Sample]]:
+    completed = {}
+    for sample in iter_completed(path):
+        completed.setdefault(sample.fingerprint(), []).append(sample)
+    return completed
+
+
+def load_replies(path_pattern: str) -> Dict[str, Tuple[str, float]]:
+    """
+    Index the raw_output and latency of finished samples in the output files matching a glob pattern
+    by a hash of their prompt.
+    """
+    replies = {}
+    for path in sorted(glob(path_pattern)):
+        for sample in iter_completed(path):
+            replies[hashlib.sha256(sample.prompt.encode()).hexdigest()] = (sample.raw_output, sample.latency)
+    return replies
+
+
+def get_data_path(name: str) -> str:
     if name == "sudoku":
-        return Data.load("data/sudoku_questions.json")
+        return "data/sudoku_questions.json"
     elif name == "sudoku_states":
-        return Data.load("data/sudoku_states.json")
+        return "data/sudoku_states.json"
     elif name == "graphcoloring":
-        return Data.load("data/graphcoloring_questions.json")
+        return "data/graphcoloring_questions.json"
     elif name == "graphcoloring_states":
-        return Data.load("data/graphcoloring_states.json")
+        return "data/graphcoloring_states.json"
     elif name == "game24":
-        return Data.load("data/game24_questions.json")
+        return "data/game24_questions.json"
     elif name == "game24_states":
-        return Data.load("data/game24_states.json")
+        return "data/game24_states.json"
     elif name == "gridpuzzle":
-        return Data.load("data/gridpuzzle_questions.json")
+        return "data/gridpuzzle_questions.json"
     elif name == "gridpuzzle_states":
-        return Data.load("data/gridpuzzle_states.json")
+        return "data/gridpuzzle_states.json"
     else:
         raise KeyError(name)
 
 
+def select_data(name: str, **kwargs):
+    return Data.load(get_data_path(name))
+
+
 def test_data(name: str, **kwargs):
     data = select_data(name, **kwargs)
     data.analyze()
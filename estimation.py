@@ -0,0 +1,88 @@
+import random
+from collections import Counter
+from statistics import NormalDist
+from typing import Dict, List
+
+from data_loading import Sample
+
+
+def get_stratum(sample: Sample) -> str:
+    """
+    Stratify by the solvability of the current state and, where the data records the path to it, its depth.
+    """
+    stratum = str(sample.outputs.get("current_status", ""))
+    if "initial_to_current" in sample.inputs:
+        stratum += f"@{len(sample.inputs['initial_to_current']) - 1}"
+    return stratum
+
+
+def stratified_order(strata: List[str], seed: int = 0) -> List[int]:
+    """
+    Shuffle positions within each stratum, then interleave the strata so that every prefix of the
+    order samples each stratum in proportion to its size.
+    """
+    rng = random.Random(seed)
+    groups: Dict[str, List[int]] = {}
+    for i, stratum in enumerate(strata):
+        groups.setdefault(stratum, []).append(i)
+    for group in groups.values():
+        rng.shuffle(group)
+
+    order, taken = [], Counter()
+    for step in range(len(strata)):
+        # Take from the stratum furthest behind its proportional share
+        stratum = max(groups, key=lambda h: len(groups[h]) * (step + 1) / len(strata) - taken[h])
+        order.append(groups[stratum][taken[stratum]])
+        taken[stratum] += 1
+    return order
+
+
+class StratifiedEstimator:
+    """
+    Running stratified estimate of the mean score over a finite population, with a normal-approximation
+    confidence interval. Strata with fewer than two scores assume the largest possible variance of a
+    score in [0, 1], so the interval stays conservative until every stratum has been seen. After that, the variance
+    is at least that of the adjusted proportion (sum + 1) / (n + 2), so a stratum whose scores all agree so far
+    is not taken to be known exactly.
+    """
+
+    def __init__(self, strata: List[str], confidence: float = 0.95):
+        self.sizes = Counter(strata)
+        self.total = len(strata)
+        self.scores: Dict[str, List[float]] = {stratum: [] for stratum in self.sizes}
+        self.z = NormalDist().inv_cdf((1 + confidence) / 2)
+
+    def add(self, stratum: str, score: float):
+        self.scores[stratum].append(score)
+
+    def mean(self) -> float:
+        observed = [s for scores in self.scores.values() for s in scores]
+        fallback = sum(observed) / max(len(observed), 1)
+        total = 0.0
+        for stratum, size in self.sizes.items():
+            scores = self.scores[stratum]
+            total += size / self.total * (sum(scores) / len(scores) if scores else fallback)
+        return total
+
+    def margin(self) -> float:
+        variance = 0.0
+        for stratum, size in self.sizes.items():
+            scores = self.scores[stratum]
+            n = len(scores)
+            if n < 2:
+                variance += (size / self.total) ** 2 * 0.25 / max(n, 1)
+                continue
+            mean = sum(scores) / n
+            adjusted = (sum(scores) + 1) / (n + 2)
+            sample_variance = max(sum((s - mean) ** 2 for s in scores) / (n - 1), adjusted * (1 - adjusted))
+            # Finite population correction, the margin reaches zero once a stratum is fully scored
+            variance += (size / self.total) ** 2 * sample_variance / n * (1 - n / size)
+        return self.z * variance ** 0.5
+
+    def summary(self) -> dict:
+        return dict(
+            estimate=self.mean(),
+            margin=self.margin(),
+            scored=sum(len(scores) for scores in self.scores.values()),
+            strata={stratum: len(scores) for stratum, scores in self.scores.items()},
+        )
@@ -0,0 +1,123 @@
+import asyncio
+import contextvars
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+
+class HedgePolicy:
+    """
+    Tracks recent request latencies for an engine and decides when a slow request gets a duplicate.
+    A request is hedged once it has run longer than the given percentile of recent latencies,
+    as long as at most max_fraction of all requests have been hedged.
+    """
+
+    def __init__(self, max_fraction: float, percentile: float = 0.95, window: int = 1000, min_samples: int = 20):
+        self.max_fraction = max_fraction
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.latencies = deque(maxlen=window)
+        self.requests = 0
+        self.hedges = 0
+        self.lock = threading.Lock()
+
+    def start(self) -> Optional[float]:
+        """
+        Count a new request and return the seconds after which it should be hedged, or None if it should not be.
+        """
+        with self.lock:
+            self.requests += 1
+            if self.max_fraction <= 0 or len(self.latencies) < self.min_samples:
+                return None
+            latencies = sorted(self.latencies)
+            return latencies[int(self.percentile * (len(latencies) - 1))]
+
+    def record(self, latency: float):
+        with self.lock:
+            self.latencies.append(latency)
+
+    def try_hedge(self) -> bool:
+        with self.lock:
+            if self.hedges + 1 > self.max_fraction * self.requests:
+                return False
+            self.hedges += 1
+            return True
+
+
+hedge_policies: Dict[Tuple, HedgePolicy] = {}
+hedge_policies_lock = threading.Lock()
+hedge_executor = ThreadPoolExecutor(max_workers=512, thread_name_prefix="hedge")
+
+
+def get_hedge_policy(key: str, max_fraction: float, percentile: float = 0.95) -> HedgePolicy:
+    """
+    Return the policy for an engine, so latencies observed by every model instance of the engine are pooled.
+    """
+    with hedge_policies_lock:
+        full_key = (key, max_fraction, percentile)
+        if full_key not in hedge_policies:
+            hedge_policies[full_key] = HedgePolicy(max_fraction, percentile)
+        return hedge_policies[full_key]
+
+
+def send_hedged(send: Callable[[], Any], policy: HedgePolicy, on_hedge: Callable[[], None] = lambda: None) -> Any:
+    """
+    Call send, and call it again if the first call is still running after the policy's delay.
+    Returns the first successful response, or raises the last error if both calls fail.
+    Blocking calls cannot be cancelled, so the slower call is left to finish and its response is dropped.
+    """
+    delay = policy.start()
+    start = time.time()
+    if delay is None:
+        response = send()
+        policy.record(time.time() - start)
+        return response
+
+    # Calls run in a copy of the caller's context, so backends can still report stats for the caller's sample
+    running = {hedge_executor.submit(contextvars.copy_context().run, send)}
+    done, _ = wait(running, timeout=delay)
+    if not done and policy.try_hedge():
+        on_hedge()
+        running.add(hedge_executor.submit(contextvars.copy_context().run, send))
+    while running:
+        done, running = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                policy.record(time.time() - start)
+                for other in running:
+                    other.cancel()
+                return future.result()
+    return future.result()
+
+
+async def asend_hedged(
+    send: Callable[[], Awaitable[Any]], policy: HedgePolicy, on_hedge: Callable[[], None] = lambda: None
+) -> Any:
+    """
+    Async version of send_hedged, where the slower call is cancelled once the other succeeds.
+    """
+    delay = policy.start()
+    start = time.time()
+    if delay is None:
+        response = await send()
+        policy.record(time.time() - start)
+        return response
+
+    running = {asyncio.ensure_future(send())}
+    try:
+        done, _ = await asyncio.wait(running, timeout=delay)
+        if not done and policy.try_hedge():
+            on_hedge()
+            running.add(asyncio.ensure_future(send()))
+        while running:
+            done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    policy.record(time.time() - start)
+                    return task.result()
+        return task.result()
+    finally:
+        for task in running:
+            task.cancel()
@@ -0,0 +1,89 @@
+import hashlib
+import json
+import threading
+from contextlib import contextmanager
+from typing import Any, Iterator, List, Tuple
+
+from rate_limiting import RateLimiter, get_rate_limiter, get_retry_after, get_status_code
+
+# A key that is out of quota or not accepted is benched, so requests go to the other keys for a while
+BENCH_STATUS_CODES = {401, 403, 429}
+
+
+class APIKey:
+    """
+    An API key with its own requests-per-minute and tokens-per-minute budget, and the backend clients using it.
+    """
+
+    def __init__(self, api_key: str, limiter: RateLimiter, base_url: str = ""):
+        self.api_key = api_key
+        self.limiter = limiter
+        self.base_url = base_url
+        self.client: Any = None
+        self.async_client: Any = None
+        self.in_flight = 0
+
+
+class KeyPool:
+    """
+    Spreads requests over API keys, sending each to the key that can take it soonest and, among those,
+    has the fewest requests in flight. A key that answers with a 429 or an auth error is paused for its
+    Retry-After, or cooldown seconds, while other keys are available to take its requests.
+    """
+
+    def __init__(self, keys: List[APIKey], cooldown: float = 60.0):
+        if not keys:
+            raise ValueError("A key pool needs at least one key")
+        self.keys = keys
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def acquire(self, tokens: float = 0) -> Iterator[Tuple[APIKey, float]]:
+        """
+        Pick a key for a request with the given tokens, and yield it with the seconds to wait before sending.
+        The key counts the request as in flight until the block exits.
+        """
+        with self.lock:
+            key = min(self.keys, key=lambda key: (key.limiter.get_wait(tokens), key.in_flight))
+            key.in_flight += 1
+        try:
+            yield key, key.limiter.reserve(tokens)
+        finally:
+            with self.lock:
+                key.in_flight -= 1
+
+    def bench(self, key: APIKey, error: Exception) -> bool:
+        """
+        Pause a key that failed with a 429 or an auth error, and return whether another key can take the retry.
+        A lone key is never benched, so its errors are handled as usual.
+        """
+        others = [other for other in self.keys if other is not key and not other.limiter.is_paused()]
+        if get_status_code(error) not in BENCH_STATUS_CODES or not others:
+            return False
+        key.limiter.pause(get_retry_after(error) or self.cooldown)
+        print(f"Benched API key ...{key.api_key[-4:]}, {len(others)} other keys available")
+        return True
+
+
+def load_key_pool(
+    path: str, engine: str, requests_per_minute: float = 0, tokens_per_minute: float = 0, cooldown: float = 60.0
+) -> KeyPool:
+    """
+    Read a key file holding either {"api_key": ...} or {"api_keys": [...]}, where each key is a string or a dict
+    with api_key and optionally its own requests_per_minute, tokens_per_minute and base_url.
+    Keys without limits of their own use the given ones.
+    """
+    with open(path) as f:
+        info = json.load(f)
+    keys = []
+    for entry in info["api_keys"] if "api_keys" in info else [info]:
+        entry = dict(api_key=entry) if isinstance(entry, str) else entry
+        # Quotas belong to a key and engine, so every model using the same pair shares one budget
+        limiter = get_rate_limiter(
+            f"{hashlib.sha256(entry['api_key'].encode()).hexdigest()}:{engine}",
+            entry.get("requests_per_minute", requests_per_minute),
+            entry.get("tokens_per_minute", tokens_per_minute),
+        )
+        keys.append(APIKey(entry["api_key"], limiter, entry.get("base_url", "")))
+    return KeyPool(keys, cooldown)
@@ -1,11 +1,354 @@
+import asyncio
+import hashlib
+import json
+import os
+import signal
+import threading
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from itertools import count, islice
 from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
 from fire import Fire
 from tqdm import tqdm
 
-from data_loading import select_data
-from modeling import select_model
-from prompting import select_prompter
-from scoring import select_scorer
+from accounting import RunSummary
+from data_loading import (
+    Data,
+    ResultWriter,
+    Sample,
+    get_data_path,
+    iter_completed,
+    iter_samples,
+    load_completed,
+    save_samples,
+    select_data,
+)
+from estimation import StratifiedEstimator, get_stratum, stratified_order
+from modeling import EvalModel, PrecomputedModel, answer_pattern, request_stats, select_model
+from prompting import PromptContext, Prompter, select_prompter
+from rate_limiting import RequestError
+from scheduling import order_by_cost
+from scoring import Scorer, select_scorer
+from work_queue import WorkQueue
+
+
+def set_outputs(sample: Sample, prompter: Prompter, context: PromptContext, outputs: List[str]):
+    """
+    Parse each completion of a sample, vote on their answers and keep a completion giving the most common one,
+    and its verdict as the pred. Completions without an answer only win if no completion has one.
+    """
+    sample.raw_outputs = outputs
+    sample.preds = [prompter.get_answer(output, context) for output in outputs]
+    answers = [prompter.parse_answer(output, context) for output in outputs]
+    votes = Counter(answer for answer in answers if answer)
+    winner = answers.index(votes.most_common(1)[0][0]) if votes else 0
+    sample.raw_output = outputs[winner] if outputs else ""
+    sample.pred = sample.preds[winner] if outputs else ""
+
+
+def set_stats(sample: Sample, stats: dict):
+    # Backends report what they measured, such as token usage, retries, cost and time to first token
+    for name, value in stats.items():
+        if name in Sample.model_fields:
+            setattr(sample, name, value)
+
+
+def process_sample(sample: Sample, prompter: Prompter, model: EvalModel, n_samples: int = 1) -> Sample:
+    # Samples are copied, so a dataset can be shared by several runs
+    sample = sample.model_copy()
+    sample.prompt, context = prompter.run(sample)
+    stats = {}
+    request_stats.set(stats)
+    answer_pattern.set(prompter.answer_pattern)
+    start = time.time()
+    try:
+        if n_samples > 1:
+            outputs = model.run_multiple([sample.prompt], n_samples)[0]
+            stats.update(stats.pop("batch", [{}])[0])
+            if isinstance(outputs, RequestError):
+                raise outputs
+        else:
+            sample.raw_output = model.run(sample.prompt)
+    except RequestError as e:
+        # Left without a raw_output, so the sample is sent again when the run is resumed
+        outputs, sample.raw_output, sample.error = [], "", str(e)
+    sample.latency = time.time() - start
+    set_stats(sample, stats)
+    if n_samples > 1:
+        set_outputs(sample, prompter, context, outputs)
+    else:
+        sample.pred = prompter.get_answer(sample.raw_output, context)
+    return sample
+
+
+def process_batch(samples: List[Sample], prompter: Prompter, model: EvalModel, n_samples: int = 1) -> List[Sample]:
+    """
+    Process samples with a single model.run_batch call, so backends that batch natively see the whole chunk.
+    Every sample records the latency of the whole call, which is how long it waited for its output,
+    and the usage, retries and cost of its own prompt. Only the samples whose prompts failed get an error.
+    """
+    if len(samples) == 1:
+        return [process_sample(samples[0], prompter, model, n_samples)]
+    samples = [sample.model_copy() for sample in samples]
+    contexts = []
+    for sample in samples:
+        sample.prompt, context = prompter.run(sample)
+        contexts.append(context)
+    prompts = [sample.prompt for sample in samples]
+    stats = {}
+    request_stats.set(stats)
+    answer_pattern.set(prompter.answer_pattern)
+    start = time.time()
+    try:
+        outputs = model.run_multiple(prompts, n_samples) if n_samples > 1 else model.run_batch(prompts)
+    except RequestError as e:
+        # Backends that generate the whole batch at once fail as a whole
+        outputs = [e] * len(samples)
+    latency = time.time() - start
+    batch = stats.get("batch", [{}] * len(samples))
+    for sample, context, output, sample_stats in zip(samples, contexts, outputs, batch):
+        sample.latency = latency
+        set_stats(sample, sample_stats)
+        if isinstance(output, RequestError):
+            output, sample.error = [] if n_samples > 1 else "", str(output)
+        if n_samples > 1:
+            set_outputs(sample, prompter, context, output)
+        else:
+            sample.raw_output = output
+            sample.pred = prompter.get_answer(output, context)
+    return samples
+
+
+async def aprocess_sample(sample: Sample, prompter: Prompter, model: EvalModel, n_samples: int = 1) -> Sample:
+    sample = sample.model_copy()
+    sample.prompt, context = prompter.run(sample)
+    stats = {}
+    request_stats.set(stats)
+    answer_pattern.set(prompter.answer_pattern)
+    start = time.time()
+    try:
+        if n_samples > 1:
+            outputs = (await model.arun_multiple([sample.prompt], n_samples))[0]
+            stats.update(stats.pop("batch", [{}])[0])
+            if isinstance(outputs, RequestError):
+                raise outputs
+        else:
+            sample.raw_output = await model.arun(sample.prompt)
+    except RequestError as e:
+        outputs, sample.raw_output, sample.error = [], "", str(e)
+    sample.latency = time.time() - start
+    set_stats(sample, stats)
+    if n_samples > 1:
+        set_outputs(sample, prompter, context, outputs)
+    else:
+        sample.pred = prompter.get_answer(sample.raw_output, context)
+    return sample
+
+
+event_loop = None
+event_loop_lock = threading.Lock()
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """
+    Event loop running on a background thread, shared by every async run in the process.
+    Async clients keep their connection pools bound to the loop they first ran on, so it is never replaced.
+    """
+    global event_loop
+    with event_loop_lock:
+        if event_loop is None:
+            event_loop = asyncio.new_event_loop()
+            threading.Thread(target=event_loop.run_forever, daemon=True).start()
+    return event_loop
+
+
+def reparse_sample(sample: Sample, prompter: Prompter) -> Sample:
+    # Rebuilding the prompt also rebuilds the context that get_answer reads
+    sample = sample.model_copy()
+    sample.prompt, context = prompter.run(sample)
+    if sample.raw_outputs:
+        set_outputs(sample, prompter, context, sample.raw_outputs)
+    else:
+        sample.pred = prompter.get_answer(sample.raw_output, context)
+    return sample
+
+
+def get_prompt_key(sample: Sample, prompter: Prompter) -> bytes:
+    prompt, _ = prompter.run(sample)
+    return hashlib.sha256(prompt.encode()).digest()
+
+
+def group_by_prompt(samples: List[Sample], prompter: Prompter) -> Tuple[List[int], Dict[int, List[int]]]:
+    """
+    Return the positions of the first sample of each distinct prompt, and for each of them the positions of
+    the later samples whose prompts render identically, which reuse its response instead of being sent.
+    """
+    leaders, followers, first = [], {}, {}
+    for position, sample in enumerate(samples):
+        key = get_prompt_key(sample, prompter)
+        if key in first:
+            followers.setdefault(first[key], []).append(position)
+        else:
+            first[key] = position
+            leaders.append(position)
+    return leaders, followers
+
+
+def share_output(leader: Sample, sample: Sample, prompter: Prompter) -> Sample:
+    # The response of a sample with the same prompt, parsed against this sample's own context
+    update = dict(
+        raw_output=leader.raw_output, raw_outputs=leader.raw_outputs, latency=leader.latency, error=leader.error
+    )
+    return reparse_sample(sample.model_copy(update=update), prompter)
+
+
+def run_samples(
+    samples: Iterable[Sample],
+    prompter: Prompter,
+    model: EvalModel,
+    concurrency: int = 1,
+    stop: Optional[threading.Event] = None,
+    window: Optional[int] = None,
+    use_async: bool = False,
+    batch_size: int = 1,
+    n_samples: int = 1,
+) -> Iterator[Tuple[int, Sample]]:
+    """
+    Process samples on a pool of threads and yield (position, sample) as each one completes.
+    Samples are drawn lazily so at most `concurrency` are in flight, and none are started once `stop` is set.
+    With a window, no sample is started `window` or more positions after the oldest one still running,
+    which bounds how many finished samples can wait to be written in dataset order.
+    With use_async, samples run as coroutines on a shared event loop using model.arun, so high
+    concurrency does not need a thread per request.
+    With batch_size, samples are sent in chunks through model.run_batch and `concurrency` chunks are in flight.
+    With n_samples, each prompt gets that many completions and its pred is their majority answer.
+    """
+    concurrency = max(concurrency, 1)
+    batch_size = max(batch_size, 1)
+    if use_async and batch_size > 1:
+        raise ValueError("use_async cannot be combined with batch_size, which sends chunks through run_batch")
+    pending = enumerate(samples)
+    next_position = 0
+    with ThreadPoolExecutor(max_workers=1 if use_async else concurrency) as executor:
+        def submit(chunk: List[Sample]) -> Future:
+            if use_async:
+                return asyncio.run_coroutine_threadsafe(aprocess_sample(chunk[0], prompter, model, n_samples), get_event_loop())
+            return executor.submit(process_batch, chunk, prompter, model, n_samples)
+
+        running = {}
+        while True:
+            while len(running) < concurrency and (stop is None or not stop.is_set()):
+                if window and running and next_position - min(min(indices) for indices in running.values()) >= window:
+                    break
+                chunk = list(islice(pending, batch_size))
+                if not chunk:
+                    break
+                indices = [index for index, _ in chunk]
+                running[submit([sample for _, sample in chunk])] = indices
+                next_position = indices[-1] + 1
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                # Async futures hold one sample, batches hold a list
+                results = future.result()
+                yield from zip(running.pop(future), [results] if isinstance(results, Sample) else results)
+
+
+@contextmanager
+def graceful_interrupt() -> Iterator[threading.Event]:
+    """
+    On the first Ctrl+C, set the yielded event instead of raising so in-flight samples can be written out.
+    """
+    stop = threading.Event()
+    if threading.current_thread() is not threading.main_thread():
+        yield stop
+        return
+
+    def interrupt(signum, frame):
+        print("Interrupted: finishing in-flight samples, press Ctrl+C again to abort")
+        stop.set()
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+
+    previous_handler = signal.signal(signal.SIGINT, interrupt)
+    try:
+        yield stop
+    finally:
+        signal.signal(signal.SIGINT, previous_handler)
+
+
+def report(
+    sample: Sample,
+    is_correct: List[float],
+    progress: tqdm,
+    on_result: Optional[Callable[[Sample, float], None]] = None,
+):
+    score = sum(is_correct) / len(is_correct)
+    progress.update()
+    progress.set_postfix(score=score)
+    print(sample.model_dump_json(indent=2))
+    print(dict(is_correct=is_correct[-1]))
+    if on_result is not None:
+        on_result(sample, is_correct[-1])
+
+
+def save_summary(summary: RunSummary, output_path: str, worker_id: str = ""):
+    """
+    Save the run summary next to the output file, named apart from it so that globs over outputs skip it.
+    """
+    stem = output_path.split(".jsonl")[0]
+    path = f"{stem}.{worker_id}.summary.json" if worker_id else f"{stem}.summary.json"
+    info = summary.save(path)
+    print(
+        f"Run summary saved to {path}: {info['samples_per_second']:.2f} samples/s, "
+        f"{info['tokens_per_second']:.0f} tokens/s, p50/p95/p99 latency "
+        f"{info['latency_p50']:.1f}/{info['latency_p95']:.1f}/{info['latency_p99']:.1f}s, cost ${info['cost']:.4f}"
+    )
+
+
+def merge_completed(paths: Iterable[str], samples: List[Sample]) -> List[Sample]:
+    """
+    Collect the finished samples from several output files and return them in dataset order.
+    """
+    completed = {}
+    for path in paths:
+        for key, matches in load_completed(path).items():
+            completed.setdefault(key, []).extend(matches)
+
+    merged = []
+    for sample in samples:
+        matches = completed.get(sample.fingerprint())
+        if matches:
+            merged.append(matches.pop(0))
+    return merged
+
+
+COMPRESSION_SUFFIXES = dict(gzip=".gz", zstd=".zst")
+
+
+def get_output_path(
+    output_folder: str,
+    data_name: str,
+    prompter_name: str,
+    model_name: str,
+    compression: str = "",
+    num_shards: int = 1,
+    shard_id: int = 0,
+    n_samples: int = 1,
+) -> str:
+    output_path = f"{output_folder}/{data_name}_{prompter_name}_{model_name}"
+    if n_samples > 1:
+        output_path += f"_n{n_samples}"
+    if num_shards > 1:
+        output_path += f"_shard{shard_id}of{num_shards}"
+    output_path += ".jsonl"
+    if compression:
+        output_path += COMPRESSION_SUFFIXES[compression]
+    return output_path
 
 
 def evaluate(
@@ -15,35 +358,583 @@ def evaluate(
     scorer_name: str = "state_transition_accuracy",
     start_index: int = 0,
     output_folder: str = "outputs",
+    concurrency: int = 1,
+    use_async: bool = False,
+    batch_size: int = 1,
+    n_samples: int = 1,
+    sync_interval: float = 1.0,
+    compression: str = "",
+    num_shards: int = 1,
+    shard_id: int = 0,
+    queue_dir: str = "",
+    lease_timeout: float = 600.0,
+    stream: bool = False,
+    schedule: bool = False,
+    margin: float = 0.0,
+    confidence: float = 0.95,
+    max_samples: int = 0,
+    max_cost: float = 0.0,
+    seed: int = 0,
+    batch_api: bool = False,
     **kwargs,
 ):
-    data = select_data(data_name)
-    prompter = select_prompter(prompter_name)
+    data = None if stream else select_data(data_name)
     model = select_model(model_name, **kwargs)
+    run_evaluation(
+        data,
+        model,
+        data_name,
+        prompter_name,
+        model_name,
+        scorer_name=scorer_name,
+        start_index=start_index,
+        output_folder=output_folder,
+        concurrency=concurrency,
+        use_async=use_async,
+        batch_size=batch_size,
+        n_samples=n_samples,
+        sync_interval=sync_interval,
+        compression=compression,
+        num_shards=num_shards,
+        shard_id=shard_id,
+        queue_dir=queue_dir,
+        lease_timeout=lease_timeout,
+        stream=stream,
+        schedule=schedule,
+        margin=margin,
+        confidence=confidence,
+        max_samples=max_samples,
+        max_cost=max_cost,
+        seed=seed,
+        batch_api=batch_api,
+    )
+
+
+def run_evaluation(
+    data: Optional[Data],
+    model: EvalModel,
+    data_name: str,
+    prompter_name: str,
+    model_name: str,
+    scorer_name: str = "state_transition_accuracy",
+    start_index: int = 0,
+    output_folder: str = "outputs",
+    concurrency: int = 1,
+    use_async: bool = False,
+    batch_size: int = 1,
+    n_samples: int = 1,
+    sync_interval: float = 1.0,
+    compression: str = "",
+    num_shards: int = 1,
+    shard_id: int = 0,
+    queue_dir: str = "",
+    lease_timeout: float = 600.0,
+    stream: bool = False,
+    schedule: bool = False,
+    margin: float = 0.0,
+    confidence: float = 0.95,
+    max_samples: int = 0,
+    max_cost: float = 0.0,
+    seed: int = 0,
+    batch_api: bool = False,
+    on_result: Optional[Callable[[Sample, float], None]] = None,
+) -> dict:
+    """
+    Evaluate an already loaded dataset and model, calling on_result with each finished sample and its score.
+    With stream, samples are read from the data file (if data is not given) and dropped once written.
+    With schedule, samples expected to take longest (by latency in earlier outputs of this dataset and model,
+    else by prompt length) are dispatched first.
+    With margin, max_samples or max_cost, samples are drawn stratified by status and depth until the confidence
+    interval of the score is within ±margin, max_samples new samples have been sent or the finished ones have cost
+    max_cost US dollars. Requests in flight when the budget runs out still finish, so a run can go slightly over it.
+    With batch_api, all prompts are sent as one offline batch job and the run resumes once it finishes.
+    Returns a summary with the output path, number of samples and score.
+    """
+    prompter = select_prompter(prompter_name)
     scorer = select_scorer(scorer_name)
+    is_adaptive = margin > 0 or max_samples > 0 or max_cost > 0
+    if batch_api and (stream or queue_dir or is_adaptive or n_samples > 1):
+        raise ValueError("batch_api cannot be combined with stream, queue_dir, margin, max_samples, max_cost or n_samples")
+
+    if stream:
+        if queue_dir or schedule or is_adaptive:
+            raise ValueError(
+                "stream cannot be combined with queue_dir, schedule, margin, max_samples or max_cost, which need all samples up front"
+            )
+        output_path = get_output_path(
+            output_folder, data_name, prompter_name, model_name, compression, num_shards, shard_id, n_samples
+        )
+        def read_samples() -> Iterator[Sample]:
+            samples = iter_samples(get_data_path(data_name)) if data is None else iter(data.samples)
+            samples = islice(samples, max(start_index, 0), None)
+            return (sample for sample in samples if sample.in_shard(num_shards, shard_id))
+
+        # A first pass counts the prompts, so only responses of prompts that come up again are kept for them
+        prompt_counts = Counter(get_prompt_key(sample, prompter) for sample in read_samples())
+        return run_stream(
+            read_samples(), prompter, model, scorer, output_path, concurrency, use_async, batch_size, n_samples,
+            sync_interval, on_result, prompt_counts,
+        )
 
     if (start_index < 0) or (start_index >= len(data.samples)):
         start_index = 0
     if start_index != 0:
         data_name = f"{data_name}_{start_index}"
 
-    output_path = f"{output_folder}/{data_name}_{prompter_name}_{model_name}.jsonl"
-    Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+    output_path = get_output_path(
+        output_folder, data_name, prompter_name, model_name, compression, num_shards, shard_id, n_samples
+    )
+    samples = Data(samples=data.samples[start_index:]).shard(num_shards, shard_id).samples
+    history_pattern = f"{output_folder}/{data_name}_*_{model_name}*.jsonl*" if schedule else ""
+    if queue_dir:
+        if is_adaptive:
+            raise ValueError("queue_dir cannot be combined with margin, max_samples or max_cost")
+        return run_queue(
+            samples, prompter, model, scorer, output_path, queue_dir, lease_timeout, concurrency, use_async, batch_size,
+            n_samples, sync_interval, compression, history_pattern=history_pattern, on_result=on_result,
+        )
+
+    # Resume: samples whose inputs already have a raw_output in the output file are not sent again
+    completed = load_completed(output_path)
+    resumed, todo = [], []
+    for i, sample in enumerate(samples):
+        matches = completed.get(sample.fingerprint())
+        if matches:
+            samples[i] = matches.pop(0)
+            resumed.append(i)
+        else:
+            todo.append(i)
+    if resumed:
+        print(f"Resuming {output_path}: {len(resumed)} of {len(samples)} samples already done")
+        Data(samples=[samples[i] for i in resumed]).save(output_path)
+
+    estimator = None
+    if is_adaptive:
+        # Adaptive: draw samples stratified by status and depth until the score is known well enough
+        if schedule:
+            raise ValueError("schedule cannot be combined with margin, max_samples or max_cost, which fix the sampling order")
+        strata = [get_stratum(sample) for sample in samples]
+        estimator = StratifiedEstimator(strata, confidence)
+        order = stratified_order([strata[i] for i in todo], seed)
+        todo = [todo[i] for i in order]
+    elif schedule:
+        order = order_by_cost([samples[i] for i in todo], prompter, history_pattern)
+        todo = [todo[i] for i in order]
+    in_order = estimator is None and not schedule
+
+    is_correct = []
+    for i in resumed:
+        is_correct.append(scorer.run(samples[i]))
+        if estimator is not None:
+            estimator.add(strata[i], is_correct[-1])
+        if on_result is not None:
+            on_result(samples[i], is_correct[-1])
+
+    # Samples whose prompts render identically share one request, the others reuse its raw_output
+    leaders, followers = group_by_prompt([samples[i] for i in todo], prompter)
+    prompts = [prompter.run(samples[todo[position]])[0] for position in leaders] if batch_api else []
+
+    batch_state_path = f"{output_path}.batch.json"
+    if batch_api and prompts:
+        # The batch results then go through the usual pipeline, as if the model had answered each prompt
+        outputs, errors, stats = model.run_batch_api(prompts, batch_state_path)
+        model = PrecomputedModel(outputs=outputs, errors=errors, stats=stats)
+
+    dispatched = []
+    def dispatch() -> Iterator[Sample]:
+        for count, position in enumerate(leaders):
+            if max_samples > 0 and count >= max_samples:
+                return
+            if max_cost > 0 and summary.cost >= max_cost:
+                print(f"Stopped after spending ${summary.cost:.4f} of the ${max_cost:.4f} budget")
+                return
+            if estimator is not None and margin > 0 and estimator.margin() <= margin:
+                return
+            dispatched.append(position)
+            yield samples[todo[position]]
+
+    done = list(resumed)
+    summary = RunSummary()
+    progress = tqdm(total=len(samples), initial=len(resumed), desc=output_path)
+    with graceful_interrupt() as stop, ResultWriter(output_path, sync_interval, append=bool(resumed)) as writer:
+        results = run_samples(
+            dispatch(), prompter, model, concurrency, stop, use_async=use_async, batch_size=batch_size, n_samples=n_samples
+        )
+        for index, leader in results:
+            position = dispatched[index]
+            finished = [(position, leader)]
+            for follower in followers.get(position, []):
+                finished.append((follower, share_output(leader, samples[todo[follower]], prompter)))
+
+            for position, sample in finished:
+                samples[todo[position]] = sample
+                done.append(todo[position])
+                summary.add(sample)
+                is_correct.append(scorer.run(sample))
+                if estimator is not None:
+                    estimator.add(strata[todo[position]], is_correct[-1])
+                    progress.set_description(f"{output_path} ±{estimator.margin():.3f}")
+                report(sample, is_correct, progress, on_result)
+                # Out of order runs are written as they finish, waiting for dataset order would hold back most results
+                writer.write(position if in_order else len(done) - len(resumed) - 1, sample)
+    progress.close()
+
+    if stop.is_set():
+        raise KeyboardInterrupt(f"Stopped early, rerun the same command to resume {output_path}")
+    if batch_api and os.path.exists(batch_state_path):
+        os.remove(batch_state_path)
+    if len(done) > len(resumed):
+        save_summary(summary, output_path)
+    if len(done) > len(resumed) and (resumed or not in_order):
+        # Results were not written in dataset order, restore it now that the run is complete
+        Data(samples=[samples[i] for i in sorted(done)]).save(output_path)
+    info = dict(output_path=output_path, samples=len(is_correct), score=sum(is_correct) / max(len(is_correct), 1))
+    if n_samples > 1:
+        passed = [scorer.pass_at_k(samples[i]) for i in done]
+        info.update(pass_at_k=sum(passed) / max(len(passed), 1))
+    if estimator is not None:
+        info.update(estimator.summary())
+        print(json.dumps(info, indent=2))
+    return info
 
+
+def run_stream(
+    samples: Iterable[Sample],
+    prompter: Prompter,
+    model: EvalModel,
+    scorer: Scorer,
+    output_path: str,
+    concurrency: int = 1,
+    use_async: bool = False,
+    batch_size: int = 1,
+    n_samples: int = 1,
+    sync_interval: float = 1.0,
+    on_result: Optional[Callable[[Sample, float], None]] = None,
+    prompt_counts: Optional[Counter] = None,
+) -> dict:
+    """
+    Evaluate samples as they are read and drop each one once it is written, so memory does not grow
+    with the dataset or the length of the outputs. Resuming only keeps fingerprints in memory, and
+    resumed samples stay at the start of the output file rather than being put back in dataset order.
+    Samples whose prompt renders like an earlier one reuse its response. prompt_counts, the number of samples
+    with each prompt key, says which responses to keep for later samples and until when.
+    """
+    completed = Counter()
+    is_correct, passed = [], []
+
+    def read_completed() -> Iterator[Sample]:
+        for sample in iter_completed(output_path):
+            completed[sample.fingerprint()] += 1
+            is_correct.append(scorer.run(sample))
+            passed.append(scorer.pass_at_k(sample))
+            if on_result is not None:
+                on_result(sample, is_correct[-1])
+            yield sample
+
+    prompt_counts = Counter() if prompt_counts is None else prompt_counts
+    waiting: Dict[bytes, List[Tuple[int, Sample]]] = {}
+    kept: Dict[bytes, Sample] = {}
+    dispatched: Dict[int, Tuple[int, bytes]] = {}
+    shared: List[Tuple[int, Sample]] = []
+    indices, positions = count(), count()
+
+    def read_todo() -> Iterator[Sample]:
+        for sample in samples:
+            key = sample.fingerprint()
+            prompt_key = get_prompt_key(sample, prompter)
+            prompt_counts[prompt_key] -= 1
+            if completed[key] > 0:
+                completed[key] -= 1
+            elif prompt_key in kept:
+                # The response of this prompt came back already
+                shared.append((next(indices), share_output(kept[prompt_key], sample, prompter)))
+            elif prompt_key in waiting:
+                # The same prompt is in flight, this sample gets its response when it arrives
+                waiting[prompt_key].append((next(indices), sample))
+            else:
+                waiting[prompt_key] = []
+                dispatched[next(positions)] = (next(indices), prompt_key)
+                yield sample
+            if prompt_counts[prompt_key] <= 0:
+                kept.pop(prompt_key, None)
+
+    if os.path.exists(output_path):
+        # Copy the finished samples over once, which also drops a line torn by a crash
+        save_samples(read_completed(), output_path)
+        print(f"Resuming {output_path}: {len(is_correct)} samples already done")
+
+    summary = RunSummary()
+    progress = tqdm(initial=len(is_correct), desc=output_path)
+    with graceful_interrupt() as stop, ResultWriter(output_path, sync_interval, append=True) as writer:
+        # A window of a few batches keeps the pool busy past a slow sample while bounding the write buffer
+        def finish(index: int, sample: Sample):
+            summary.add(sample)
+            is_correct.append(scorer.run(sample))
+            passed.append(scorer.pass_at_k(sample))
+            report(sample, is_correct, progress, on_result)
+            writer.write(index, sample)
+
+        for position, leader in run_samples(
+            read_todo(), prompter, model, concurrency, stop, window=16 * concurrency * batch_size,
+            use_async=use_async, batch_size=batch_size, n_samples=n_samples,
+        ):
+            index, prompt_key = dispatched.pop(position)
+            finish(index, leader)
+            for index, sample in waiting.pop(prompt_key):
+                finish(index, share_output(leader, sample, prompter))
+            if prompt_counts[prompt_key] > 0:
+                kept[prompt_key] = leader
+            while shared:
+                finish(*shared.pop(0))
+        while shared:
+            finish(*shared.pop(0))
+    progress.close()
+
+    if stop.is_set():
+        raise KeyboardInterrupt(f"Stopped early, rerun the same command to resume {output_path}")
+    if summary.latencies:
+        save_summary(summary, output_path)
+    info = dict(output_path=output_path, samples=len(is_correct), score=sum(is_correct) / max(len(is_correct), 1))
+    if n_samples > 1:
+        info.update(pass_at_k=sum(passed) / max(len(passed), 1))
+    return info
+
+
+def run_queue(
+    samples: List[Sample],
+    prompter: Prompter,
+    model: EvalModel,
+    scorer: Scorer,
+    output_path: str,
+    queue_dir: str,
+    lease_timeout: float = 600.0,
+    concurrency: int = 1,
+    use_async: bool = False,
+    batch_size: int = 1,
+    n_samples: int = 1,
+    sync_interval: float = 1.0,
+    compression: str = "",
+    poll_interval: float = 10.0,
+    history_pattern: str = "",
+    on_result: Optional[Callable[[Sample, float], None]] = None,
+) -> dict:
+    """
+    Work through a queue shared by any number of workers, which can join or leave at any time.
+    Each worker appends its results to its own file, and whichever worker sees the queue drain
+    merges all results into output_path. Samples that fail stay in the queue, and each worker tries them
+    once per run, so a rerun retries them. Only the first sample of each distinct prompt is leased, and the
+    samples sharing its prompt are done along with it.
+    """
+    queue = WorkQueue(queue_dir, len(samples), lease_timeout)
+    # Every worker derives the same order, so the most expensive samples are leased first
+    order = order_by_cost(samples, prompter, history_pattern) if history_pattern else list(range(len(samples)))
+    results_path = f"{queue_dir}/results/{queue.worker_id}.jsonl"
+    if compression:
+        results_path += COMPRESSION_SUFFIXES[compression]
     is_correct = []
-    progress = tqdm(data.samples[start_index:], desc=output_path)
-    for sample in progress:
-        sample.prompt = prompter.run(sample)
-        sample.raw_output = model.run(sample.prompt)
-        sample.pred = prompter.get_answer(sample.raw_output)
+    summary = RunSummary()
+    failed = set()
+    # Every worker derives the same groups, followers are only sent themselves if their leader is done without them
+    _, followers = group_by_prompt(samples, prompter)
+    leader_of = {follower: leader for leader, group in followers.items() for follower in group}
+    progress = tqdm(total=len(queue.remaining()), desc=f"{output_path} ({queue.worker_id})")
+    with graceful_interrupt() as stop, queue, ResultWriter(results_path, sync_interval, append=True) as writer:
+        while not stop.is_set():
+            undone = set(queue.remaining())
+            remaining = {index for index in undone - failed if leader_of.get(index) not in failed}
+            if not remaining:
+                break
+            remaining = [index for index in order if index in remaining and leader_of.get(index) not in undone]
+
+            leased = []
+            def lease():
+                for index in queue.lease(remaining):
+                    leased.append(index)
+                    yield samples[index]
+
+            finished = run_samples(
+                lease(), prompter, model, concurrency, stop, use_async=use_async, batch_size=batch_size, n_samples=n_samples
+            )
+            for position, leader in finished:
+                index = leased[position]
+                shared = [(follower, share_output(leader, samples[follower], prompter)) for follower in followers.get(index, [])]
+                for _, sample in [(index, leader)] + shared:
+                    summary.add(sample)
+                    is_correct.append(scorer.run(sample))
+                    report(sample, is_correct, progress, on_result)
+                    writer.write(len(is_correct) - 1, sample)
+                writer.sync()
+                if leader.error:
+                    failed.add(index)
+                    queue.release(index)
+                else:
+                    # Followers are marked first, so a crash in between leaves the leader to be redone with them
+                    for follower, _ in shared:
+                        queue.mark_done(follower)
+                    queue.mark_done(index)
+            if not leased:
+                # Everything left is leased by other workers, wait for them to finish or for leases to expire
+                time.sleep(poll_interval)
+    progress.close()
+
+    if stop.is_set():
+        raise KeyboardInterrupt(f"Stopped early, rerun the same command to rejoin {queue_dir}")
+    if failed:
+        left = sum(1 + len(followers.get(index, [])) for index in failed)
+        print(f"{left} samples failed and are left in {queue_dir}, rerun the same command to retry them")
+    if summary.latencies:
+        # Each worker summarizes the samples it sent, as workers may have run on different machines
+        save_summary(summary, output_path, queue.worker_id)
+    results_paths = [str(path) for path in sorted(Path(f"{queue_dir}/results").iterdir()) if not path.name.startswith(".")]
+    merged = merge_completed(results_paths, samples)
+    Data(samples=merged).save(output_path)
+    scores = [scorer.run(sample) for sample in merged]
+    info = dict(output_path=output_path, samples=len(merged), score=sum(scores) / max(len(scores), 1))
+    if n_samples > 1:
+        info.update(pass_at_k=sum(scorer.pass_at_k(sample) for sample in merged) / max(len(merged), 1))
+    print(json.dumps(info, indent=2))
+    return info
+
+
+def merge(
+    data_name: str,
+    prompter_name: str,
+    model_name: str,
+    num_shards: int,
+    scorer_name: str = "state_transition_accuracy",
+    output_folder: str = "outputs",
+    compression: str = "",
+    n_samples: int = 1,
+):
+    data = select_data(data_name)
+    scorer = select_scorer(scorer_name)
+
+    shard_paths = [
+        get_output_path(output_folder, data_name, prompter_name, model_name, compression, num_shards, shard_id, n_samples)
+        for shard_id in range(num_shards)
+    ]
+    merged = merge_completed(shard_paths, data.samples)
+    output_path = get_output_path(output_folder, data_name, prompter_name, model_name, compression, n_samples=n_samples)
+    Data(samples=merged).save(output_path)
+    is_correct = [scorer.run(sample) for sample in merged]
+    info = dict(
+        output_path=output_path,
+        samples=len(merged),
+        missing=len(data.samples) - len(merged),
+        score=sum(is_correct) / max(len(is_correct), 1),
+    )
+    print(json.dumps(info, indent=2))
+
+
+
+def rescore(
+    path: str,
+    prompter_name: str,
+    scorer_name: str = "state_transition_accuracy",
+    save_path: str = "",
+    num_workers: int = 0,
+):
+    """
+    Re-parse and re-score the raw outputs stored in an output file without calling any model, e.g. after
+    a change to a get_answer parser. Parsing and verification are spread over a process pool, and the
+    updated samples are written to save_path (default: overwrite path).
+    """
+    prompter = select_prompter(prompter_name)
+    scorer = select_scorer(scorer_name)
+    samples = Data.load(path).samples
+    before = [scorer.run(sample) for sample in samples]
+
+    num_workers = num_workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        chunksize = max(len(samples) // (num_workers * 4), 1)
+        samples = list(executor.map(reparse_sample, samples, [prompter] * len(samples), chunksize=chunksize))
+
+    after = [scorer.run(sample) for sample in samples]
+    Data(samples=samples).save(save_path or path)
+    info = dict(
+        output_path=save_path or path,
+        samples=len(samples),
+        changed=sum(a != b for a, b in zip(before, after)),
+        score_before=sum(before) / max(len(before), 1),
+        score=sum(after) / max(len(after), 1),
+    )
+    if any(sample.raw_outputs for sample in samples):
+        info.update(pass_at_k=sum(scorer.pass_at_k(sample) for sample in samples) / max(len(samples), 1))
+    print(json.dumps(info, indent=2))
+
+
+def get_default_task(prompter_name: str) -> Tuple[str, str]:
+    """
+    Return the dataset and scorer that a prompter is evaluated with, e.g. sudoku_state_checking
+    runs on sudoku_states with state_checking_accuracy.
+    """
+    puzzle, task = prompter_name.split("_", 1)
+    if task == "e2e":
+        return puzzle, "state_transition_accuracy"
+    elif task == "state_checking":
+        return f"{puzzle}_states", "state_checking_accuracy"
+    elif task == "state_transition":
+        return f"{puzzle}_states", "state_transition_accuracy"
+    else:
+        raise KeyError(prompter_name)
+
+
+def sweep(
+    model_names: Union[str, Sequence[str]],
+    prompter_names: Union[str, Sequence[str]] = tuple(
+        f"{puzzle}_{task}"
+        for puzzle in ["sudoku", "graphcoloring", "game24", "gridpuzzle"]
+        for task in ["e2e", "state_checking", "state_transition"]
+    ),
+    data_names: Union[str, Sequence[str], None] = None,
+    scorer_names: Union[str, Sequence[str], None] = None,
+    output_folder: str = "outputs",
+    concurrency: int = 1,
+    use_async: bool = False,
+    batch_size: int = 1,
+    n_samples: int = 1,
+    sync_interval: float = 1.0,
+    compression: str = "",
+    **kwargs,
+):
+    """
+    Evaluate every model on every data x prompter x scorer combination in one process, so each model
+    and dataset is loaded only once. Prompters use their default dataset and scorer unless given,
+    and combinations of a dataset and prompter from different puzzles are skipped.
+    """
+    as_list = lambda names: [names] if isinstance(names, str) else list(names)
+    tasks = []
+    for prompter_name in as_list(prompter_names):
+        default_data_name, default_scorer_name = get_default_task(prompter_name)
+        for data_name in as_list(data_names or default_data_name):
+            for scorer_name in as_list(scorer_names or default_scorer_name):
+                if data_name.split("_")[0] != prompter_name.split("_")[0]:
+                    print(f"Skipping {data_name} with {prompter_name}: different puzzles")
+                    continue
+                tasks.append((data_name, prompter_name, scorer_name))
 
-        is_correct.append(scorer.run(sample))
-        score = sum(is_correct) / len(is_correct)
-        progress.set_postfix(score=score)
-        print(sample.model_dump_json(indent=2))
-        print(dict(is_correct=is_correct[-1]))
-        data.save(output_path)
+    datasets = {}
+    for model_name in as_list(model_names):
+        model = select_model(model_name, **kwargs)
+        for data_name, prompter_name, scorer_name in tasks:
+            if data_name not in datasets:
+                datasets[data_name] = select_data(data_name)
+            run_evaluation(
+                datasets[data_name],
+                model,
+                data_name,
+                prompter_name,
+                model_name,
+                scorer_name=scorer_name,
+                output_folder=output_folder,
+                concurrency=concurrency,
+                use_async=use_async,
+                batch_size=batch_size,
+                n_samples=n_samples,
+                sync_interval=sync_interval,
+                compression=compression,
+            )
 
 
 if __name__ == "__main__":
-    Fire()
\ No newline at end of file
+    Fire()
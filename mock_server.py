@@ -0,0 +1,256 @@
+import email
+import email.policy
+import hashlib
+import json
+import math
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, Optional
+from fire import Fire
+
+from data_loading import load_replies
+
+
+class MockOpenAI:
+    """
+    In-memory stand-in for the OpenAI chat completions, files and batches endpoints, for testing without
+    an API key. Every completion returns the same reply, and batches complete batch_delay seconds after creation.
+    Streamed completions send the reply a word at a time, chunk_delay seconds apart.
+    For load testing, completions take a lognormal latency with median latency and spread latency_sigma, and fail
+    with a server error or a 429 carrying Retry-After at the given rates. With replay_path, a glob pattern of
+    output files, prompts that were answered before get their recorded output instead of the fixed reply.
+    """
+
+    def __init__(
+        self,
+        reply: str = "Answer: (A)",
+        batch_delay: float = 1.0,
+        chunk_delay: float = 0.0,
+        latency: float = 0.0,
+        latency_sigma: float = 0.0,
+        error_rate: float = 0.0,
+        rate_limit_rate: float = 0.0,
+        retry_after: float = 1.0,
+        replay_path: str = "",
+    ):
+        self.reply = reply
+        self.batch_delay = batch_delay
+        self.chunk_delay = chunk_delay
+        self.latency = latency
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.replies = {key: output for key, (output, _) in load_replies(replay_path).items()} if replay_path else {}
+        self.files: Dict[str, dict] = {}
+        self.contents: Dict[str, bytes] = {}
+        self.batches: Dict[str, dict] = {}
+        self.lock = threading.Lock()
+
+    def get_latency(self) -> float:
+        if self.latency <= 0 or self.latency_sigma <= 0:
+            return max(self.latency, 0.0)
+        return random.lognormvariate(math.log(self.latency), self.latency_sigma)
+
+    def get_fault(self) -> Optional[int]:
+        """
+        Status code of an injected failure, or None if the request should succeed.
+        """
+        draw = random.random()
+        if draw < self.rate_limit_rate:
+            return 429
+        if draw < self.rate_limit_rate + self.error_rate:
+            return 500
+        return None
+
+    def complete(self, body: dict) -> dict:
+        messages = body.get("messages", [])
+        content = self.reply
+        if messages and self.replies:
+            key = hashlib.sha256(str(messages[-1]["content"]).encode()).hexdigest()
+            content = self.replies.get(key, self.reply)
+        prompt = " ".join(str(message["content"]) for message in messages)
+        return dict(
+            id=f"chatcmpl-{uuid.uuid4().hex}",
+            object="chat.completion",
+            created=int(time.time()),
+            model=body.get("model", ""),
+            choices=[
+                dict(index=i, message=dict(role="assistant", content=content), finish_reason="stop")
+                for i in range(body.get("n", 1))
+            ],
+            usage=dict(
+                prompt_tokens=len(prompt) // 4,
+                completion_tokens=len(content) * body.get("n", 1) // 4,
+                total_tokens=(len(prompt) + len(content) * body.get("n", 1)) // 4,
+            ),
+        )
+
+    def stream(self, body: dict) -> Iterator[dict]:
+        completion = self.complete(body)
+        header = dict(id=completion["id"], object="chat.completion.chunk", created=completion["created"], model=completion["model"])
+        words = completion["choices"][0]["message"]["content"].split(" ")
+        for i, word in enumerate(words):
+            time.sleep(self.chunk_delay)
+            delta = dict(content=word if i == 0 else " " + word)
+            yield dict(header, choices=[dict(index=0, delta=delta, finish_reason="stop" if i == len(words) - 1 else None)])
+        if body.get("stream_options", {}).get("include_usage"):
+            yield dict(header, choices=[], usage=completion["usage"])
+
+    def add_file(self, content: bytes, filename: str, purpose: str) -> dict:
+        file = dict(
+            id=f"file-{uuid.uuid4().hex}",
+            object="file",
+            bytes=len(content),
+            created_at=int(time.time()),
+            filename=filename,
+            purpose=purpose,
+            status="processed",
+        )
+        with self.lock:
+            self.files[file["id"]] = file
+            self.contents[file["id"]] = content
+        return file
+
+    def create_batch(self, body: dict) -> dict:
+        batch = dict(
+            id=f"batch_{uuid.uuid4().hex}",
+            object="batch",
+            endpoint=body["endpoint"],
+            input_file_id=body["input_file_id"],
+            completion_window=body.get("completion_window", "24h"),
+            status="in_progress",
+            created_at=int(time.time()),
+            output_file_id=None,
+            error_file_id=None,
+            request_counts=dict(total=0, completed=0, failed=0),
+        )
+        with self.lock:
+            self.batches[batch["id"]] = batch
+        threading.Timer(self.batch_delay, self.finish_batch, [batch["id"]]).start()
+        return batch
+
+    def finish_batch(self, batch_id: str):
+        batch = self.batches[batch_id]
+        lines = []
+        for line in self.contents[batch["input_file_id"]].decode().splitlines():
+            if line.strip():
+                request = json.loads(line)
+                response = dict(status_code=200, request_id=uuid.uuid4().hex, body=self.complete(request["body"]))
+                lines.append(json.dumps(dict(id=uuid.uuid4().hex, custom_id=request["custom_id"], response=response, error=None)))
+        output = self.add_file("\n".join(lines).encode(), f"{batch_id}_output.jsonl", "batch_output")
+        with self.lock:
+            batch.update(
+                status="completed",
+                output_file_id=output["id"],
+                completed_at=int(time.time()),
+                request_counts=dict(total=len(lines), completed=len(lines), failed=0),
+            )
+
+
+class MockRequestHandler(BaseHTTPRequestHandler):
+    def send_json(self, info: dict, status: int = 200, headers: Optional[Dict[str, str]] = None):
+        body = json.dumps(info).encode()
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        mock = self.server.mock
+        parts = self.path.rstrip("/").split("/")
+        if self.path.startswith("/v1/batches/") and parts[-1] in mock.batches:
+            self.send_json(mock.batches[parts[-1]])
+        elif self.path.startswith("/v1/files/") and self.path.endswith("/content") and parts[-2] in mock.contents:
+            body = mock.contents[parts[-2]]
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.path.startswith("/v1/files/") and parts[-1] in mock.files:
+            self.send_json(mock.files[parts[-1]])
+        else:
+            self.send_json(dict(error=dict(message=f"Not found: {self.path}")), 404)
+
+    def do_POST(self):
+        mock = self.server.mock
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path == "/v1/chat/completions":
+            time.sleep(mock.get_latency())
+            fault = mock.get_fault()
+            if fault == 429:
+                error = dict(message="Rate limit reached", type="requests", code="rate_limit_exceeded")
+                self.send_json(dict(error=error), 429, {"Retry-After": str(mock.retry_after)})
+                return
+            if fault is not None:
+                self.send_json(dict(error=dict(message="The server had an error", type="server_error")), fault)
+                return
+
+        if self.path == "/v1/chat/completions" and json.loads(body).get("stream"):
+            # Server-sent events, ended by closing the connection
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.end_headers()
+            try:
+                for chunk in mock.stream(json.loads(body)):
+                    self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                    self.wfile.flush()
+                self.wfile.write(b"data: [DONE]\n\n")
+            except (BrokenPipeError, ConnectionResetError):
+                # Clients that stop reading early, e.g. once the answer has arrived, just drop the connection
+                pass
+        elif self.path == "/v1/chat/completions":
+            self.send_json(mock.complete(json.loads(body)))
+        elif self.path == "/v1/batches":
+            self.send_json(mock.create_batch(json.loads(body)))
+        elif self.path == "/v1/files":
+            # Uploads are multipart forms with a purpose field and a file field
+            header = f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode()
+            form = email.message_from_bytes(header + body, policy=email.policy.HTTP)
+            fields = {part.get_param("name", header="content-disposition"): part for part in form.iter_parts()}
+            file = fields["file"]
+            purpose = fields["purpose"].get_content().strip()
+            self.send_json(mock.add_file(file.get_payload(decode=True), file.get_filename(), purpose))
+        else:
+            self.send_json(dict(error=dict(message=f"Not found: {self.path}")), 404)
+
+    def log_message(self, format: str, *args):
+        pass
+
+
+def serve(
+    host: str = "127.0.0.1",
+    port: int = 8000,
+    reply: str = "Answer: (A)",
+    batch_delay: float = 1.0,
+    chunk_delay: float = 0.0,
+    latency: float = 0.0,
+    latency_sigma: float = 0.0,
+    error_rate: float = 0.0,
+    rate_limit_rate: float = 0.0,
+    retry_after: float = 1.0,
+    replay_path: str = "",
+):
+    """
+    Serve a local OpenAI stand-in, for use with --base_url http://127.0.0.1:8000/v1
+    """
+    server = ThreadingHTTPServer((host, port), MockRequestHandler)
+    server.mock = MockOpenAI(
+        reply, batch_delay, chunk_delay, latency, latency_sigma, error_rate, rate_limit_rate, retry_after, replay_path
+    )
+    print(f"Serving a mock OpenAI API on http://{host}:{port}/v1")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    Fire()
@@ -0,0 +1,92 @@
+import importlib.util
+import sys
+import time
+import types
+from collections import Counter
+from typing import Any, List
+
+from fire import Fire
+
+from main import evaluate
+
+
+class MockSamplingParams:
+    def __init__(self, n: int = 1, **kwargs):
+        self.n = n
+        self.kwargs = kwargs
+
+
+class MockLLM:
+    """
+    Stand-in for vllm.LLM, for checking how prompts are batched without a GPU. Every completion returns the same
+    reply, each generate call takes delay seconds plus delay_per_prompt for each of its prompts, and the number of
+    prompts in each call is recorded in batch_sizes.
+    """
+
+    def __init__(self, reply: str = "Answer: (A)", delay: float = 0.0, delay_per_prompt: float = 0.0):
+        self.reply = reply
+        self.delay = delay
+        self.delay_per_prompt = delay_per_prompt
+        self.batch_sizes: List[int] = []
+
+    def generate(self, prompts: List[str], sampling_params: Any, use_tqdm: bool = True, lora_request: Any = None):
+        self.batch_sizes.append(len(prompts))
+        time.sleep(self.delay + self.delay_per_prompt * len(prompts))
+        completion = types.SimpleNamespace(text=self.reply, token_ids=list(range(len(self.reply) // 4)))
+        return [
+            types.SimpleNamespace(
+                prompt_token_ids=list(range(len(prompt) // 4)), outputs=[completion] * getattr(sampling_params, "n", 1)
+            )
+            for prompt in prompts
+        ]
+
+
+def install():
+    """
+    Register stand-ins for the vllm modules that VLLMModel imports, unless vllm is installed.
+    """
+    if importlib.util.find_spec("vllm") is not None:
+        return
+    vllm = types.ModuleType("vllm")
+    vllm.LLM = MockLLM
+    vllm.SamplingParams = MockSamplingParams
+    lora = types.ModuleType("vllm.lora")
+    request = types.ModuleType("vllm.lora.request")
+    request.LoRARequest = lambda *args, **kwargs: None
+    sys.modules.update({"vllm": vllm, "vllm.lora": lora, "vllm.lora.request": request})
+
+
+def run(
+    data_name: str = "sudoku_states",
+    prompter_name: str = "sudoku_state_checking",
+    scorer_name: str = "state_checking_accuracy",
+    output_folder: str = "outputs/mock_vllm",
+    reply: str = "Answer: (A)",
+    delay: float = 0.0,
+    delay_per_prompt: float = 0.0,
+    **kwargs,
+):
+    """
+    Evaluate with a mock vLLM engine and report the sizes of the generate calls it received, e.g.
+    python mock_vllm.py run --batch_size 256 --concurrency 4
+    """
+    install()
+    llm = MockLLM(reply, delay, delay_per_prompt)
+    start = time.time()
+    evaluate(
+        data_name,
+        prompter_name,
+        "qwen",
+        scorer_name=scorer_name,
+        output_folder=output_folder,
+        path_model="mock",
+        model=llm,
+        **kwargs,
+    )
+    sizes = Counter(llm.batch_sizes)
+    print(dict(calls=len(llm.batch_sizes), prompts=sum(llm.batch_sizes), duration=time.time() - start))
+    print("Prompts per generate call:", dict(sorted(sizes.items())))
+
+
+if __name__ == "__main__":
+    Fire()
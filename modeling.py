@@ -1,26 +1,51 @@
+import asyncio
+import hashlib
 import json
+import os
+import threading
 import time
-import torch
-import google.generativeai as genai
-from openai import OpenAI
-from pydantic import BaseModel
-from typing import Optional, List
-from transformers import AutoTokenizer, PreTrainedTokenizer
+import uuid
+from concurrent.futures import Future
+from contextvars import ContextVar
+from pydantic import BaseModel, PrivateAttr
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, Optional, List, Tuple, Union
 from fire import Fire
 
+from accounting import BATCH_API_DISCOUNT, get_cost
+from caching import ResponseCache
+from data_loading import load_replies
+from hedging import HedgePolicy, asend_hedged, get_hedge_policy, send_hedged
+from key_pool import APIKey, KeyPool, load_key_pool
+from rate_limiting import RequestError, get_backoff, get_retry_after, get_status_code, is_retryable, is_transport_error
+from streaming import StreamRecorder, aread_stream, read_stream
 
-class DummyImport:
-    LLM = None
-    SamplingParams = None
+# Backend libraries (torch, transformers, vllm, openai, google.generativeai) are imported inside the
+# models that use them, so only the backend that is actually loaded pays for its import.
 
+# Measurements of the request behind the current run call, such as time to first token. Callers that want
+# them set a fresh dict before calling run, and backends fill it in with record_stats.
+request_stats: ContextVar[Optional[dict]] = ContextVar("request_stats", default=None)
+# The answer marker of the prompt being run, where streams stop early unless the model has a stop_pattern of its own
+answer_pattern: ContextVar[str] = ContextVar("answer_pattern", default="")
 
-try:
-    import vllm
-    from vllm.lora.request import LoRARequest
-except ImportError:
-    print("vLLM not installed")
-    vllm = DummyImport()
-    LoRARequest = lambda *args: args
+
+def record_stats(**stats):
+    current = request_stats.get()
+    if current is not None:
+        current.update(stats)
+
+
+def collect_stats(call: Callable[[], Any]) -> Tuple[Any, dict]:
+    """
+    Return the result of a call along with the stats recorded during it, so calls that cover several prompts can
+    report them per prompt, as record_stats(batch=[...]).
+    """
+    stats = {}
+    token = request_stats.set(stats)
+    try:
+        return call(), stats
+    finally:
+        request_stats.reset(token)
 
 
 class EvalModel(BaseModel, arbitrary_types_allowed=True):
@@ -30,37 +55,746 @@ class EvalModel(BaseModel, arbitrary_types_allowed=True):
     def run(self, prompt: str) -> str:
         raise NotImplementedError
 
+    async def arun(self, prompt: str) -> str:
+        # Backends without a native async client run on the event loop's thread pool
+        return await asyncio.to_thread(self.run, prompt)
+
+    def run_batch(self, prompts: List[str]) -> List[Union[str, RequestError]]:
+        """
+        Return the output of each prompt, or the RequestError it failed with, so one failure does not discard
+        the outputs of the other prompts. Backends that can generate for several prompts at once override this.
+        """
+        outputs, batch = [], []
+        for prompt in prompts:
+            try:
+                output, stats = collect_stats(lambda: self.run(prompt))
+            except RequestError as e:
+                output, stats = e, {}
+            outputs.append(output)
+            batch.append(stats)
+        record_stats(batch=batch)
+        return outputs
+
+    def run_multiple(self, prompts: List[str], n: int) -> List[Union[List[str], RequestError]]:
+        """
+        Return n completions for each prompt, or the RequestError it failed with.
+        Backends with a native n parameter get them from a single request.
+        """
+        outputs, batch = [], []
+        for prompt in prompts:
+            try:
+                output, stats = collect_stats(lambda: [self.run(prompt) for _ in range(n)])
+            except RequestError as e:
+                output, stats = e, {}
+            outputs.append(output)
+            batch.append(stats)
+        record_stats(batch=batch)
+        return outputs
+
+    async def arun_multiple(self, prompts: List[str], n: int) -> List[Union[List[str], RequestError]]:
+        return await asyncio.to_thread(self.run_multiple, prompts, n)
+
+    def run_batch_api(
+        self, prompts: List[str], state_path: str
+    ) -> Tuple[Dict[str, str], Dict[str, str], Dict[str, dict]]:
+        """
+        Run prompts as an offline batch job, returning the outputs, the errors and the usage and cost keyed by prompt.
+        """
+        raise NotImplementedError(f"{type(self).__name__} does not support a batch API")
+
+    def get_config(self) -> dict:
+        """
+        Settings that determine what run returns for a prompt, used to key cached responses.
+        """
+        # Loaded clients and engines, and settings that only affect speed, are left out
+        exclude = {
+            "client", "async_client", "model", "timeout", "max_connections", "tensor_parallel_size",
+            "max_attempts", "requests_per_minute", "tokens_per_minute", "backoff_base", "backoff_max",
+            "hedge_fraction", "hedge_percentile", "batch_api_size", "batch_poll_interval",
+            "stream_response", "partial_dir", "stop_pattern", "stop_idle", "input_price", "output_price",
+            "key_cooldown",
+        }
+        return dict(model_class=type(self).__name__, **self.model_dump(exclude=exclude))
+
+
+class CachedModel(EvalModel):
+    path_model: str = ""
+    model: EvalModel
+    cache: ResponseCache
+
+    def get_config(self) -> dict:
+        return self.model.get_config()
+
+    def run(self, prompt: str) -> str:
+        key = self.cache.make_key(self.get_config(), prompt)
+        output = self.cache.get(key)
+        if output is None:
+            output = self.model.run(prompt)
+            # Empty outputs are how the API models report failures, so they are retried next time
+            if output:
+                self.cache.put(key, output)
+        return output
+
+    async def arun(self, prompt: str) -> str:
+        key = self.cache.make_key(self.get_config(), prompt)
+        output = self.cache.get(key)
+        if output is None:
+            output = await self.model.arun(prompt)
+            if output:
+                self.cache.put(key, output)
+        return output
+
+    def run_batch(self, prompts: List[str]) -> List[Union[str, RequestError]]:
+        config = self.get_config()
+        keys = [self.cache.make_key(config, prompt) for prompt in prompts]
+        outputs = [self.cache.get(key) for key in keys]
+        misses = [i for i, output in enumerate(outputs) if output is None]
+        # Cached outputs cost nothing, the stats of the others are moved to their positions in the batch
+        batch = [{} for _ in prompts]
+        if misses:
+            results, stats = collect_stats(lambda: self.model.run_batch([prompts[i] for i in misses]))
+            for i, output, output_stats in zip(misses, results, stats.get("batch", [{}] * len(misses))):
+                outputs[i], batch[i] = output, output_stats
+                if output and not isinstance(output, RequestError):
+                    self.cache.put(keys[i], output)
+        record_stats(batch=batch)
+        return outputs
+
+    def run_multiple(self, prompts: List[str], n: int) -> List[Union[List[str], RequestError]]:
+        # The n completions of a prompt are cached together, apart from its single completion
+        config = dict(self.get_config(), n=n)
+        keys = [self.cache.make_key(config, prompt) for prompt in prompts]
+        outputs = [self.cache.get(key) for key in keys]
+        outputs = [None if output is None else json.loads(output) for output in outputs]
+        misses = [i for i, output in enumerate(outputs) if output is None]
+        batch = [{} for _ in prompts]
+        if misses:
+            results, stats = collect_stats(lambda: self.model.run_multiple([prompts[i] for i in misses], n))
+            for i, output, output_stats in zip(misses, results, stats.get("batch", [{}] * len(misses))):
+                outputs[i], batch[i] = output, output_stats
+                if not isinstance(output, RequestError) and all(output):
+                    self.cache.put(keys[i], json.dumps(output))
+        record_stats(batch=batch)
+        return outputs
+
+    def run_batch_api(
+        self, prompts: List[str], state_path: str
+    ) -> Tuple[Dict[str, str], Dict[str, str], Dict[str, dict]]:
+        config = self.get_config()
+        outputs, misses = {}, []
+        for prompt in prompts:
+            output = self.cache.get(self.cache.make_key(config, prompt))
+            if output is None:
+                misses.append(prompt)
+            else:
+                outputs[prompt] = output
+
+        results, errors, stats = self.model.run_batch_api(misses, state_path) if misses else ({}, {}, {})
+        for prompt, output in results.items():
+            if output:
+                self.cache.put(self.cache.make_key(config, prompt), output)
+        outputs.update(results)
+        return outputs, errors, stats
+
+
+class CoalescingModel(EvalModel):
+    """
+    Collapses concurrent calls with the same prompt into one call to the wrapped model, whose output
+    is returned to every caller.
+    """
+
+    path_model: str = ""
+    model: EvalModel
+    _running: Dict[str, Future] = PrivateAttr(default_factory=dict)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    def get_config(self) -> dict:
+        return self.model.get_config()
+
+    def run(self, prompt: str) -> str:
+        with self._lock:
+            future = self._running.get(prompt)
+            is_leader = future is None
+            if is_leader:
+                future = self._running[prompt] = Future()
+        if not is_leader:
+            return future.result()
+
+        try:
+            output = self.model.run(prompt)
+            future.set_result(output)
+            return output
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._running[prompt]
+
+    def claim(self, keys: List[str]) -> Tuple[List[Future], List[int]]:
+        """
+        Return the future of each key, and the positions of the keys no other call is running, which this call
+        leads. A key repeated within the call shares the future of its first position.
+        """
+        futures, led = [], []
+        with self._lock:
+            for i, key in enumerate(keys):
+                if key not in self._running:
+                    self._running[key] = Future()
+                    led.append(i)
+                futures.append(self._running[key])
+        return futures, led
+
+    def settle(self, keys: List[str], futures: List[Future], led: List[int], outputs: list):
+        for i, output in zip(led, outputs):
+            if isinstance(output, BaseException):
+                futures[i].set_exception(output)
+            else:
+                futures[i].set_result(output)
+        with self._lock:
+            for i in led:
+                del self._running[keys[i]]
+
+    @staticmethod
+    def gather(futures: List[Future], led: List[int], stats: dict) -> list:
+        # Shared outputs cost nothing, the stats of the led prompts are moved to their positions
+        batch = [{} for _ in futures]
+        for i, output_stats in zip(led, stats.get("batch", [{}] * len(led))):
+            batch[i] = output_stats
+        record_stats(batch=batch)
+        outputs = []
+        for future in futures:
+            try:
+                outputs.append(future.result())
+            except RequestError as e:
+                outputs.append(e)
+        return outputs
+
+    def run_coalesced(self, prompts: List[str], call: Callable[[List[str]], list], key_prefix: str = "") -> list:
+        """
+        Run a batch call for the prompts no other call is running, and share the outputs of the others.
+        """
+        keys = [key_prefix + prompt for prompt in prompts]
+        futures, led = self.claim(keys)
+        try:
+            outputs, stats = collect_stats(lambda: call([prompts[i] for i in led])) if led else ([], {})
+        except BaseException as e:
+            self.settle(keys, futures, led, [e] * len(led))
+            raise
+        self.settle(keys, futures, led, outputs)
+        return self.gather(futures, led, stats)
+
+    def run_batch(self, prompts: List[str]) -> List[Union[str, RequestError]]:
+        return self.run_coalesced(prompts, self.model.run_batch)
+
+    def run_multiple(self, prompts: List[str], n: int) -> List[Union[List[str], RequestError]]:
+        # Completions of a prompt are only shared with calls asking for as many
+        return self.run_coalesced(prompts, lambda prompts: self.model.run_multiple(prompts, n), f"{n}:")
+
+    async def arun_multiple(self, prompts: List[str], n: int) -> List[Union[List[str], RequestError]]:
+        keys = [f"{n}:{prompt}" for prompt in prompts]
+        futures, led = self.claim(keys)
+        stats = {}
+        token = request_stats.set(stats)
+        try:
+            outputs = await self.model.arun_multiple([prompts[i] for i in led], n) if led else []
+        except BaseException as e:
+            self.settle(keys, futures, led, [e] * len(led))
+            raise
+        finally:
+            request_stats.reset(token)
+        self.settle(keys, futures, led, outputs)
+        for i, future in enumerate(futures):
+            if i not in led:
+                try:
+                    await asyncio.wrap_future(future)
+                except RequestError:
+                    pass
+        return self.gather(futures, led, stats)
+
+    def run_batch_api(
+        self, prompts: List[str], state_path: str
+    ) -> Tuple[Dict[str, str], Dict[str, str], Dict[str, dict]]:
+        return self.model.run_batch_api(prompts, state_path)
+
+    async def arun(self, prompt: str) -> str:
+        with self._lock:
+            future = self._running.get(prompt)
+            is_leader = future is None
+            if is_leader:
+                future = self._running[prompt] = Future()
+        if not is_leader:
+            return await asyncio.wrap_future(future)
+
+        try:
+            output = await self.model.arun(prompt)
+            future.set_result(output)
+            return output
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._running[prompt]
+
+
+class PrecomputedModel(EvalModel):
+    """
+    Returns outputs that were obtained beforehand, such as the results of a batch job, along with their recorded
+    stats, and raises RequestError with the recorded error for prompts that have none.
+    """
+
+    path_model: str = ""
+    outputs: Dict[str, str]
+    errors: Dict[str, str] = {}
+    stats: Dict[str, dict] = {}
+
+    def run(self, prompt: str) -> str:
+        if prompt not in self.outputs:
+            raise RequestError(self.errors.get(prompt, "No output was obtained for this prompt"))
+        record_stats(**self.stats.get(prompt, {}))
+        return self.outputs[prompt]
+
+
+class ReplayModel(EvalModel):
+    """
+    Serves the raw_output recorded for the same prompt in earlier output files, matched by prompt hash, so the
+    pipeline can be run and benchmarked offline. path_model is a glob pattern of output files.
+    With replay_latency, each reply takes as long as the recorded request did.
+    """
+
+    path_model: str
+    replay_latency: bool = False
+    _replies: Optional[Dict[str, Tuple[str, float]]] = PrivateAttr(default=None)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    def get_reply(self, prompt: str) -> Tuple[str, float]:
+        with self._lock:
+            if self._replies is None:
+                self._replies = load_replies(self.path_model)
+                print(f"Loaded {len(self._replies)} recorded outputs from {self.path_model}")
+        key = hashlib.sha256(prompt.encode()).hexdigest()
+        if key not in self._replies:
+            raise RequestError(f"No recorded output for this prompt in {self.path_model}")
+        return self._replies[key]
+
+    def run(self, prompt: str) -> str:
+        output, latency = self.get_reply(prompt)
+        if self.replay_latency:
+            time.sleep(latency)
+        return output
+
+    async def arun(self, prompt: str) -> str:
+        output, latency = self.get_reply(prompt)
+        if self.replay_latency:
+            await asyncio.sleep(latency)
+        return output
+
+
+class APIModel(EvalModel):
+    """
+    Base for models served over an API. The key file at path_model can list several keys, and each request goes
+    to the least loaded one. A key answering with a 429 or an auth error is benched for its Retry-After or
+    key_cooldown seconds while other keys take its requests.
+    Requests wait for the shared requests-per-minute and tokens-per-minute budgets of their key and engine
+    (0 disables either), and failures are retried with exponential backoff and jitter,
+    honoring Retry-After. Permanent errors, and errors that persist for max_attempts, raise RequestError.
+    With hedge_fraction, a request still running after the hedge_percentile latency of the engine is sent
+    again and the first response wins, for at most that fraction of requests.
+    With stream_response, outputs are received incrementally and written to a file in partial_dir until they are complete.
+    With stop_idle, a stream is cut once stop_pattern (by default the answer marker of the prompter) has matched
+    and nothing arrived for stop_idle seconds.
+    Token usage, retries and the cost at input_price and output_price (US dollars per million tokens, by default
+    the listed price of the engine) are reported to the caller through record_stats.
+    """
+
+    engine: str = ""
+    max_attempts: int = 10
+    requests_per_minute: float = 0
+    tokens_per_minute: float = 0
+    backoff_base: float = 1.0
+    backoff_max: float = 60.0
+    hedge_fraction: float = 0.0
+    hedge_percentile: float = 0.95
+    stream_response: bool = False
+    partial_dir: str = "outputs/partial"
+    stop_pattern: str = ""
+    stop_idle: float = 0.0
+    input_price: Optional[float] = None
+    output_price: Optional[float] = None
+    key_cooldown: float = 60.0
+    _key_pool: Optional[KeyPool] = PrivateAttr(default=None)
+    _key_pool_lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    def make_clients(self, key: APIKey) -> Tuple[Any, Any]:
+        """
+        Create the sync and async clients that send requests with a key.
+        """
+        raise NotImplementedError
+
+    def get_key_pool(self) -> KeyPool:
+        # Clients are created once per key, and reused by every request sent with it
+        with self._key_pool_lock:
+            if self._key_pool is None:
+                pool = load_key_pool(
+                    self.path_model, self.engine, self.requests_per_minute, self.tokens_per_minute, self.key_cooldown
+                )
+                for key in pool.keys:
+                    key.client, key.async_client = self.make_clients(key)
+                self._key_pool = pool
+        return self._key_pool
+
+    def get_hedge_policy(self) -> HedgePolicy:
+        return get_hedge_policy(self.engine, self.hedge_fraction, self.hedge_percentile)
+
+    def make_recorder(self, prompt: str) -> StreamRecorder:
+        # Partial files are named by prompt hash, plus a suffix so that hedged and retried attempts do not collide
+        key = hashlib.sha256(prompt.encode()).hexdigest()
+        path = f"{self.partial_dir}/{key}.{uuid.uuid4().hex[:8]}.txt"
+        return StreamRecorder(path, self.stop_pattern or answer_pattern.get())
+
+    def read_stream(
+        self, chunks: Iterator[Tuple[str, Optional[int]]], prompt: str, close: Callable[[], None] = lambda: None
+    ) -> str:
+        recorder = self.make_recorder(prompt)
+        try:
+            output = read_stream(chunks, recorder, self.stop_idle, close)
+        except BaseException:
+            recorder.close(keep=True)
+            raise
+        recorder.close()
+        record_stats(**recorder.get_stats())
+        return output
+
+    async def aread_stream(self, chunks: AsyncIterator[Tuple[str, Optional[int]]], prompt: str) -> str:
+        recorder = self.make_recorder(prompt)
+        try:
+            output = await aread_stream(chunks, recorder, self.stop_idle)
+        except BaseException:
+            recorder.close(keep=True)
+            raise
+        recorder.close()
+        record_stats(**recorder.get_stats())
+        return output
+
+    def estimate_tokens(self, prompt: str) -> int:
+        return len(prompt) // 4
+
+    def count_tokens(self, response: Any) -> Optional[int]:
+        return None
+
+    def get_usage(self, response: Any) -> dict:
+        """
+        Return the prompt_tokens, completion_tokens and reasoning_tokens reported with a response or stream chunk,
+        or an empty dict if it reports none.
+        """
+        return {}
+
+    def record_tokens(self, usage: dict):
+        cost = get_cost(
+            self.engine, usage["prompt_tokens"], usage["completion_tokens"], self.input_price, self.output_price
+        )
+        record_stats(**usage, cost=cost)
+
+    def get_retry_delay(self, error: Exception, attempt: int, key: APIKey) -> float:
+        """
+        Return the seconds to wait before retrying after a failed attempt, or raise RequestError to give up.
+        Errors that are neither API nor connection errors are bugs, and are raised as they are.
+        """
+        if get_status_code(error) is None and not is_transport_error(error):
+            raise error
+        print(error)
+        # Errors of a benched key are retried at once on the other keys
+        benched = self.get_key_pool().bench(key, error)
+        if not is_retryable(error) and not benched:
+            raise RequestError(f"Permanent error: {error}") from error
+        if attempt + 1 >= self.max_attempts:
+            raise RequestError(f"Gave up after {self.max_attempts} attempts: {error}") from error
+        if benched:
+            return 0.0
+        retry_after = get_retry_after(error)
+        if retry_after > 0:
+            key.limiter.pause(retry_after)
+        return max(retry_after, get_backoff(attempt, self.backoff_base, self.backoff_max))
+
+    def record_usage(self, response: Any, estimate: int, key: APIKey):
+        tokens = self.count_tokens(response)
+        if tokens is not None:
+            key.limiter.record(tokens - estimate)
+        # Streamed responses are text by now, their usage was recorded from the last chunk
+        usage = self.get_usage(response)
+        if usage:
+            self.record_tokens(usage)
+
+    def request(self, send: Callable[[APIKey], Any], prompt: str) -> Any:
+        pool = self.get_key_pool()
+        estimate = self.estimate_tokens(prompt)
+        for attempt in range(self.max_attempts):
+            record_stats(retries=attempt)
+            try:
+                with pool.acquire(estimate) as (key, wait):
+                    time.sleep(wait)
+                    # Hedges go to the same key, and are charged to its budget but never wait for it
+                    response = send_hedged(
+                        lambda: send(key), self.get_hedge_policy(), on_hedge=lambda: key.limiter.reserve(estimate)
+                    )
+            except Exception as e:
+                time.sleep(self.get_retry_delay(e, attempt, key))
+                continue
+            self.record_usage(response, estimate, key)
+            return response
+
+    async def arequest(self, send: Callable[[APIKey], Awaitable[Any]], prompt: str) -> Any:
+        pool = self.get_key_pool()
+        estimate = self.estimate_tokens(prompt)
+        for attempt in range(self.max_attempts):
+            record_stats(retries=attempt)
+            try:
+                with pool.acquire(estimate) as (key, wait):
+                    await asyncio.sleep(wait)
+                    response = await asend_hedged(
+                        lambda: send(key), self.get_hedge_policy(), on_hedge=lambda: key.limiter.reserve(estimate)
+                    )
+            except Exception as e:
+                await asyncio.sleep(self.get_retry_delay(e, attempt, key))
+                continue
+            self.record_usage(response, estimate, key)
+            return response
+
 
-class OpenAIModel(EvalModel):
+class OpenAIModel(APIModel):
     path_model: str = "openai_key.json"
     engine: str = "o1-preview"
     timeout: int = 1200
-    client: Optional[OpenAI] = None
+    max_connections: int = 256
+    base_url: str = ""
+    batch_api_size: int = 50000
+    batch_poll_interval: float = 60.0
+    client: Optional[Any] = None
+    async_client: Optional[Any] = None
+
+    def make_clients(self, key: APIKey) -> Tuple[Any, Any]:
+        """
+        Each client keeps a pool of keep-alive connections that is shared by every request,
+        so concurrent requests do not pay for new connections.
+        """
+        import httpx
+        from openai import AsyncOpenAI, DefaultAsyncHttpxClient, DefaultHttpxClient, OpenAI
+
+        limits = httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections)
+        # Retries are left to APIModel.request, so the SDK does not retry on its own
+        base_url = key.base_url or self.base_url or None
+        kwargs = dict(api_key=key.api_key, timeout=self.timeout, max_retries=0, base_url=base_url)
+        return (
+            OpenAI(**kwargs, http_client=DefaultHttpxClient(limits=limits)),
+            AsyncOpenAI(**kwargs, http_client=DefaultAsyncHttpxClient(limits=limits)),
+        )
 
     def load(self):
-        with open(self.path_model) as f:
-            info = json.load(f)
-            self.client = OpenAI(api_key=info["api_key"], timeout=self.timeout)
+        # The Batch API uses the first key, as batches are retrieved with the key that created them
+        key = self.get_key_pool().keys[0]
+        self.client, self.async_client = key.client, key.async_client
+
+    def get_config(self) -> dict:
+        # path_model only points to the API key, and base_url only matters when it points away from OpenAI
+        config = super().get_config()
+        config.pop("path_model")
+        if not config["base_url"]:
+            config.pop("base_url")
+        return config
 
     def make_messages(self, prompt: str) -> List[dict]:
         return [{"role": "user", "content": prompt}]
 
+    def count_tokens(self, response: Any) -> Optional[int]:
+        # Streamed requests return their text, which has no usage
+        usage = getattr(response, "usage", None)
+        return usage.total_tokens if usage else None
+
+    def get_usage(self, response: Any) -> dict:
+        usage = getattr(response, "usage", None)
+        if not usage:
+            return {}
+        details = getattr(usage, "completion_tokens_details", None)
+        return dict(
+            prompt_tokens=usage.prompt_tokens,
+            completion_tokens=usage.completion_tokens,
+            reasoning_tokens=getattr(details, "reasoning_tokens", None) or 0,
+        )
+
+    def make_stream_kwargs(self, prompt: str) -> dict:
+        return dict(
+            model=self.engine,
+            messages=self.make_messages(prompt),
+            stream=True,
+            stream_options=dict(include_usage=True),
+        )
+
+    def parse_chunk(self, chunk: Any) -> Tuple[str, Optional[int]]:
+        # The last chunk carries the usage and no choices
+        text = (chunk.choices[0].delta.content or "") if chunk.choices else ""
+        if chunk.usage:
+            self.record_tokens(self.get_usage(chunk))
+        return text, chunk.usage.completion_tokens if chunk.usage else None
+
+    def run_stream(self, prompt: str, key: APIKey) -> str:
+        response = key.client.chat.completions.create(**self.make_stream_kwargs(prompt))
+        return self.read_stream((self.parse_chunk(chunk) for chunk in response), prompt, close=response.close)
+
+    async def arun_stream(self, prompt: str, key: APIKey) -> str:
+        response = await key.async_client.chat.completions.create(**self.make_stream_kwargs(prompt))
+        chunks = (self.parse_chunk(chunk) async for chunk in response)
+        return await self.aread_stream(chunks, prompt)
+
     def run(self, prompt: str) -> str:
-        self.load()
+        if self.stream_response:
+            return self.request(lambda key: self.run_stream(prompt, key), prompt)
+        response = self.request(
+            lambda key: key.client.chat.completions.create(model=self.engine, messages=self.make_messages(prompt)),
+            prompt,
+        )
+        return response.choices[0].message.content
+
+    async def arun(self, prompt: str) -> str:
+        if self.stream_response:
+            return await self.arequest(lambda key: self.arun_stream(prompt, key), prompt)
+        response = await self.arequest(
+            lambda key: key.async_client.chat.completions.create(
+                model=self.engine, messages=self.make_messages(prompt)
+            ),
+            prompt,
+        )
+        return response.choices[0].message.content
 
-        while True:
+    def run_multiple(self, prompts: List[str], n: int) -> List[Union[List[str], RequestError]]:
+        outputs, batch = [], []
+        for prompt in prompts:
+            stats = {}
+            token = request_stats.set(stats)
             try:
-                response = self.client.chat.completions.create(
-                    model=self.engine,
-                    messages=self.make_messages(prompt),
+                response = self.request(
+                    lambda key: key.client.chat.completions.create(
+                        model=self.engine, messages=self.make_messages(prompt), n=n
+                    ),
+                    prompt,
                 )
-                output = response.choices[0].message.content
-                break
-            except Exception as e:
-                print(e)
-                time.sleep(5)
-                continue
-        return output
+                outputs.append([choice.message.content for choice in response.choices])
+            except RequestError as e:
+                outputs.append(e)
+            finally:
+                request_stats.reset(token)
+            batch.append(stats)
+        record_stats(batch=batch)
+        return outputs
+
+    async def arun_multiple(self, prompts: List[str], n: int) -> List[Union[List[str], RequestError]]:
+        outputs, batch = [], []
+        for prompt in prompts:
+            stats = {}
+            token = request_stats.set(stats)
+            try:
+                response = await self.arequest(
+                    lambda key: key.async_client.chat.completions.create(
+                        model=self.engine, messages=self.make_messages(prompt), n=n
+                    ),
+                    prompt,
+                )
+                outputs.append([choice.message.content for choice in response.choices])
+            except RequestError as e:
+                outputs.append(e)
+            finally:
+                request_stats.reset(token)
+            batch.append(stats)
+        record_stats(batch=batch)
+        return outputs
+
+    def run_batch_api(
+        self, prompts: List[str], state_path: str
+    ) -> Tuple[Dict[str, str], Dict[str, str], Dict[str, dict]]:
+        """
+        Submit prompts as Batch API jobs of up to batch_api_size requests, and poll until they finish.
+        Submitted batch ids are saved to state_path, so an interrupted run resumes polling
+        instead of paying for the same prompts again.
+        """
+        self.load()
+        # The state must be writable before any batch is paid for
+        os.makedirs(os.path.dirname(state_path) or ".", exist_ok=True)
+        prompt_map = {hashlib.sha256(prompt.encode()).hexdigest(): prompt for prompt in prompts}
+        state = dict(batches=[])
+        if os.path.exists(state_path):
+            with open(state_path) as f:
+                state = json.load(f)
+            print(f"Resuming {len(state['batches'])} batches from {state_path}")
+
+        submitted = {key for batch in state["batches"] for key in batch["keys"]}
+        keys = [key for key in prompt_map if key not in submitted]
+        for i in range(0, len(keys), self.batch_api_size):
+            chunk = keys[i : i + self.batch_api_size]
+            lines = [
+                json.dumps(
+                    dict(
+                        custom_id=key,
+                        method="POST",
+                        url="/v1/chat/completions",
+                        body=dict(model=self.engine, messages=self.make_messages(prompt_map[key])),
+                    )
+                )
+                for key in chunk
+            ]
+            file = self.client.files.create(file=("batch.jsonl", "\n".join(lines).encode()), purpose="batch")
+            batch = self.client.batches.create(
+                input_file_id=file.id, endpoint="/v1/chat/completions", completion_window="24h"
+            )
+            state["batches"].append(dict(id=batch.id, keys=chunk))
+            temp_path = f"{state_path}.tmp"
+            with open(temp_path, "w") as f:
+                json.dump(state, f)
+            os.replace(temp_path, state_path)
+            print(f"Submitted batch {batch.id} with {len(chunk)} requests")
+
+        outputs, errors, stats = {}, {}, {}
+        for info in state["batches"]:
+            batch = self.client.batches.retrieve(info["id"])
+            while batch.status not in ["completed", "failed", "expired", "cancelled"]:
+                counts = batch.request_counts
+                print(f"Batch {batch.id} {batch.status}: {counts.completed if counts else 0}/{len(info['keys'])} done")
+                time.sleep(self.batch_poll_interval)
+                batch = self.client.batches.retrieve(info["id"])
+
+            for file_id in [batch.output_file_id, batch.error_file_id]:
+                if not file_id:
+                    continue
+                for line in self.client.files.content(file_id).text.splitlines():
+                    if not line.strip():
+                        continue
+                    result = json.loads(line)
+                    prompt = prompt_map.get(result["custom_id"])
+                    response = result.get("response") or {}
+                    if prompt is None:
+                        continue
+                    if response.get("status_code") == 200:
+                        outputs[prompt] = response["body"]["choices"][0]["message"]["content"]
+                        stats[prompt] = self.get_batch_usage(response["body"].get("usage") or {})
+                    else:
+                        errors[prompt] = json.dumps(result.get("error") or response.get("body"))
+            for key in info["keys"]:
+                if key in prompt_map and prompt_map[key] not in outputs:
+                    errors.setdefault(prompt_map[key], f"Batch {batch.id} {batch.status} without a result")
+        return outputs, errors, stats
+
+    def get_batch_usage(self, usage: dict) -> dict:
+        # Batch results report usage as plain json, and are billed at a discount
+        if not usage:
+            return {}
+        stats = dict(
+            prompt_tokens=usage["prompt_tokens"],
+            completion_tokens=usage["completion_tokens"],
+            reasoning_tokens=(usage.get("completion_tokens_details") or {}).get("reasoning_tokens") or 0,
+        )
+        cost = get_cost(
+            self.engine, stats["prompt_tokens"], stats["completion_tokens"], self.input_price, self.output_price
+        )
+        return dict(stats, cost=cost * BATCH_API_DISCOUNT)
 
 
 class OpenAIGPT4Model(OpenAIModel):
@@ -71,31 +805,35 @@ class OpenAIGPT3Model(OpenAIModel):
     engine: str = "gpt-3.5-turbo"
 
 
-class GeminiFlashThinkingModel(EvalModel):
+class GeminiFlashThinkingModel(APIModel):
     path_model: str = "gemini_key.json"
     engine: str = "gemini-2.0-flash-thinking-exp-01-21"
     timeout: int = 600
-    model: Optional[genai.GenerativeModel] = None
+    model: Optional[Any] = None
 
-    def load(self):
-        with open(self.path_model) as f:
-            info = json.load(f)
-            api_key = info["api_key"]
-            genai.configure(api_key=api_key)
-            self.model = genai.GenerativeModel(self.engine)
+    def get_config(self) -> dict:
+        # path_model only points to the API key
+        config = super().get_config()
+        config.pop("path_model")
+        return config
 
-    def run(self, prompt: str) -> str:
-        self.load()
+    def make_clients(self, key: APIKey) -> Tuple[Any, Any]:
+        import google.ai.generativelanguage as glm
+        import google.generativeai as genai
 
-        while True:
-            try:
-                response = self.model.generate_content(prompt)
-                break
-            except Exception as e:
-                print(e)
-                time.sleep(5)
-                continue
-        
+        model = genai.GenerativeModel(self.engine)
+        if self.model is None:
+            # The first key is configured globally, so its model uses the default clients
+            genai.configure(api_key=key.api_key)
+            self.model = model
+        else:
+            # The API key is a global setting of genai, so models of other keys get service clients of their own
+            model._client = glm.GenerativeServiceClient(client_options=dict(api_key=key.api_key))
+            model._async_client = glm.GenerativeServiceAsyncClient(client_options=dict(api_key=key.api_key))
+        return model, model
+
+    @staticmethod
+    def get_text(response) -> str:
         try:
             output = response.text
         except Exception as e:
@@ -103,6 +841,49 @@ class GeminiFlashThinkingModel(EvalModel):
 
         return output
 
+    def count_tokens(self, response: Any) -> Optional[int]:
+        usage = getattr(response, "usage_metadata", None)
+        return usage.total_token_count if usage else None
+
+    def get_usage(self, response: Any) -> dict:
+        usage = getattr(response, "usage_metadata", None)
+        if not usage:
+            return {}
+        # Thinking tokens are counted apart from the candidates, but billed as output
+        reasoning = getattr(usage, "thoughts_token_count", 0) or 0
+        return dict(
+            prompt_tokens=usage.prompt_token_count or 0,
+            completion_tokens=(usage.candidates_token_count or 0) + reasoning,
+            reasoning_tokens=reasoning,
+        )
+
+    def parse_chunk(self, chunk: Any) -> Tuple[str, Optional[int]]:
+        usage = getattr(chunk, "usage_metadata", None)
+        if usage:
+            # Each chunk reports the usage so far, so the last one recorded is the total
+            self.record_tokens(self.get_usage(chunk))
+        return self.get_text(chunk), usage.candidates_token_count if usage else None
+
+    def run_stream(self, prompt: str, key: APIKey) -> str:
+        response = key.client.generate_content(prompt, stream=True)
+        return self.read_stream((self.parse_chunk(chunk) for chunk in response), prompt)
+
+    async def arun_stream(self, prompt: str, key: APIKey) -> str:
+        response = await key.async_client.generate_content_async(prompt, stream=True)
+        return await self.aread_stream((self.parse_chunk(chunk) async for chunk in response), prompt)
+
+    def run(self, prompt: str) -> str:
+        if self.stream_response:
+            return self.request(lambda key: self.run_stream(prompt, key), prompt)
+        response = self.request(lambda key: key.client.generate_content(prompt), prompt)
+        return self.get_text(response)
+
+    async def arun(self, prompt: str) -> str:
+        if self.stream_response:
+            return await self.arequest(lambda key: self.arun_stream(prompt, key), prompt)
+        response = await self.arequest(lambda key: key.async_client.generate_content_async(prompt), prompt)
+        return self.get_text(response)
+
 
 class GeminiFlashModel(GeminiFlashThinkingModel):
     engine: str = "gemini-2.0-flash-exp"
@@ -110,39 +891,41 @@ class GeminiFlashModel(GeminiFlashThinkingModel):
 
 class VLLMModel(EvalModel):
     path_lora: str = ""
-    model: vllm.LLM = None
+    model: Optional[Any] = None
     quantization: Optional[str] = None
-    tokenizer: Optional[PreTrainedTokenizer] = None
     tensor_parallel_size: Optional[int] = None
     max_output_length: int = 512
     stopping_words: Optional[List[str]] = None
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
 
     def load(self):
-        if self.model is None:
-            available_gpus = torch.cuda.device_count()
-            if available_gpus == 0:
-                raise EnvironmentError("No GPUs detected.")
-
-            if self.tensor_parallel_size is None:
-                self.tensor_parallel_size = available_gpus
-                print(f"tensor_parallel_size not set. Using all available GPUs: {self.tensor_parallel_size}")
-            else:
-                if self.tensor_parallel_size > available_gpus:
-                    raise ValueError(
-                        f"tensor_parallel_size ({self.tensor_parallel_size}) exceeds the number of available GPUs ({available_gpus})."
-                    )
-                print(f"Using tensor_parallel_size: {self.tensor_parallel_size} out of {available_gpus} available GPUs.")
-
-            self.model = vllm.LLM(
-                model=self.path_model,
-                trust_remote_code=True,
-                quantization=self.quantization,
-                enable_lora=self.path_lora != "",
-                tensor_parallel_size=self.tensor_parallel_size,
-            )
-
-        if self.tokenizer is None:
-            self.tokenizer = AutoTokenizer.from_pretrained(self.path_model)
+        # A model given directly, such as mock_vllm.MockLLM, is used as is
+        if self.model is not None:
+            return
+        import torch
+        import vllm
+
+        available_gpus = torch.cuda.device_count()
+        if available_gpus == 0:
+            raise EnvironmentError("No GPUs detected.")
+
+        if self.tensor_parallel_size is None:
+            self.tensor_parallel_size = available_gpus
+            print(f"tensor_parallel_size not set. Using all available GPUs: {self.tensor_parallel_size}")
+        else:
+            if self.tensor_parallel_size > available_gpus:
+                raise ValueError(
+                    f"tensor_parallel_size ({self.tensor_parallel_size}) exceeds the number of available GPUs ({available_gpus})."
+                )
+            print(f"Using tensor_parallel_size: {self.tensor_parallel_size} out of {available_gpus} available GPUs.")
+
+        self.model = vllm.LLM(
+            model=self.path_model,
+            trust_remote_code=True,
+            quantization=self.quantization,
+            enable_lora=self.path_lora != "",
+            tensor_parallel_size=self.tensor_parallel_size,
+        )
 
     def format_prompt(self, prompt: str) -> str:
         self.load()
@@ -150,6 +933,9 @@ class VLLMModel(EvalModel):
         return prompt
 
     def make_kwargs(self, do_sample: bool, **kwargs) -> dict:
+        import vllm
+        from vllm.lora.request import LoRARequest
+
         if self.stopping_words:
             kwargs.update(stop=self.stopping_words)
         params = vllm.SamplingParams(
@@ -162,15 +948,47 @@ class VLLMModel(EvalModel):
             outputs.update(lora_request=LoRARequest("lora", 1, self.path_lora))
         return outputs
 
-    def run(self, prompt: str) -> str:
-        prompt = self.format_prompt(prompt)
-        outputs = self.model.generate([prompt], **self.make_kwargs(do_sample=False))
-        pred = outputs[0].outputs[0].text
-        pred = pred.split("<|endoftext|>")[0]
-        return pred
-
+    @staticmethod
+    def record_usage(outputs: list):
+        record_stats(
+            batch=[
+                dict(
+                    prompt_tokens=len(output.prompt_token_ids or []),
+                    completion_tokens=sum(len(completion.token_ids) for completion in output.outputs),
+                )
+                for output in outputs
+            ]
+        )
 
-def select_model(model_name: str, **kwargs) -> EvalModel:
+    def run(self, prompt: str) -> str:
+        outputs, stats = collect_stats(lambda: self.run_batch([prompt]))
+        record_stats(**stats["batch"][0])
+        return outputs[0]
+
+    def run_batch(self, prompts: List[str]) -> List[str]:
+        # vLLM engines are not thread-safe, so concurrent callers take turns
+        with self._lock:
+            prompts = [self.format_prompt(prompt) for prompt in prompts]
+            outputs = self.model.generate(prompts, **self.make_kwargs(do_sample=False))
+        self.record_usage(outputs)
+        return [output.outputs[0].text.split("<|endoftext|>")[0] for output in outputs]
+
+    def run_multiple(self, prompts: List[str], n: int) -> List[List[str]]:
+        # Sampling is needed for the n completions of a prompt to differ
+        with self._lock:
+            prompts = [self.format_prompt(prompt) for prompt in prompts]
+            outputs = self.model.generate(prompts, **self.make_kwargs(do_sample=True, n=n))
+        self.record_usage(outputs)
+        return [[completion.text.split("<|endoftext|>")[0] for completion in output.outputs] for output in outputs]
+
+
+def select_model(
+    model_name: str,
+    cache_path: str = "",
+    cache_max_age: float = 0.0,
+    cache_max_size: int = 0,
+    **kwargs,
+) -> EvalModel:
     model_map = dict(
         o1=OpenAIModel,
         gpt_4o=OpenAIGPT4Model,
@@ -178,11 +996,16 @@ def select_model(model_name: str, **kwargs) -> EvalModel:
         gemini_flash=GeminiFlashModel,
         gemini_flash_thinking=GeminiFlashThinkingModel,
         qwen=VLLMModel,
+        replay=ReplayModel,
     )
     model_class = model_map.get(model_name)
     if model_class is None:
         raise ValueError(f"{model_name}. Choose from {list(model_map.keys())}")
-    return model_class(**kwargs)
+    model = model_class(**kwargs)
+    if cache_path:
+        cache = ResponseCache(cache_path, max_age=cache_max_age, max_size=cache_max_size)
+        model = CachedModel(model=model, cache=cache)
+    return CoalescingModel(model=model)
 
 
 def test_model(
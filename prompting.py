@@ -1,6 +1,6 @@
 import ast
 import re
-import sympy
+from typing import Tuple
 from fire import Fire
 from pydantic import BaseModel
 
@@ -11,22 +11,104 @@ from game24_tree import GameOf24Tree
 from gridpuzzle_tree import LogicGridPuzzleTree
 
 
+class PromptContext(BaseModel, frozen=True):
+    """
+    What get_answer needs to know about the sample a prompt was made from, returned by run alongside the prompt.
+    Contexts are immutable and picklable, so a prompter can be shared across threads and outputs can be parsed
+    in other processes.
+    """
+
+
+class SolutionContext(PromptContext, frozen=True):
+    solution: list
+
+
+class GraphContext(PromptContext, frozen=True):
+    graph: list
+    chromatic_number: int
+
+
+class Game24Context(PromptContext, frozen=True):
+    numbers: list
+
+
+class TransitionContext(PromptContext, frozen=True):
+    parent_state: list
+    current_state: list
+    unsolvable_child: list
+    current_status: str
+
+
+class GraphColoringTransitionContext(TransitionContext, frozen=True):
+    graph: list
+    chromatic_number: int
+
+
+class Game24TransitionContext(TransitionContext, frozen=True):
+    numbers: list
+
+
+class GridPuzzleTransitionContext(TransitionContext, frozen=True):
+    initial_state: list
+    applied_clues: list
+    all_clues: dict
+    domain: dict
+
+
 class Prompter(BaseModel):
-    def run(self, sample: Sample) -> str:
+    """
+    Turns a sample into a prompt and parses model outputs. Prompters hold no per-sample state: run returns
+    the prompt with the context that get_answer reads.
+    """
+
+    # Regex that matches once a streamed output contains the final answer, used to stop streams early
+    answer_pattern: str = ""
+
+    def run(self, sample: Sample) -> Tuple[str, PromptContext]:
+        raise NotImplementedError
+
+    def get_answer(self, raw: str, context: PromptContext) -> str:
         raise NotImplementedError
 
+    def parse_answer(self, raw: str, context: PromptContext) -> str:
+        """
+        The final answer of an output, normalized so that equal answers compare equal, or "" if there is none.
+        Completions of a prompt vote on it. Prompters whose get_answer returns the answer itself, rather than
+        a verdict on it, need not override this.
+        """
+        return self.get_answer(raw, context)
+
+
+def parse_grid(raw: str, marker: str) -> str:
+    pattern = r'\[(\d,\s*\d,\s*\d,\s*\d,\s*\d,\s*\d,\s*\d,\s*\d,\s*\d)\]'
+    matches = re.findall(pattern, raw.split(marker)[-1])[-9:]
+    return str([[int(x.strip()) for x in match.split(',')] for match in matches]) if matches else ""
+
+
+def parse_coloring(raw: str, marker: str) -> str:
+    coloring = re.findall(r"\d+", raw.split(marker)[-1])
+    return str([int(x) for x in coloring]) if coloring else ""
+
+
+def parse_table(raw: str, marker: str) -> str:
+    try:
+        match = re.findall(r"\[\s*\[.*?\]\s*\]", raw.split(marker)[-1].replace("\n", ""), re.DOTALL)[-1]
+        return str(ast.literal_eval(match))
+    except:
+        return ""
+
 
 class SudokuEndToEndPrompter(Prompter):
-    solution: list = []
-    def run(self, sample: Sample) -> str:
+    answer_pattern: str = "Solution:"
+    def run(self, sample: Sample) -> Tuple[str, SolutionContext]:
         instruction = "You are given a 9x9 Sudoku grid represented as a list of lists, where empty cells are represented as 0. Your task is to fill the empty cells, ensuring that each row, column, and 3x3 subgrid contains unique numbers from 1 to 9."
         initial_grid = sample.inputs["initial"]
         solution = sample.outputs["final"]
-        self.solution = solution
+        context = SolutionContext(solution=solution)
         anser_format = "End your answer with \"Solution: \{grid\}\" where grid is in the same format as the Initial Grid."
-        return f"{instruction}\nInitial Grid: {initial_grid}\nLet's think step by step. Do not solve using programming.\n{anser_format}"
+        return f"{instruction}\nInitial Grid: {initial_grid}\nLet's think step by step. Do not solve using programming.\n{anser_format}", context
     
-    def get_answer(self, raw: str) -> str:
+    def get_answer(self, raw: str, context: SolutionContext) -> str:
         raw = raw.split("Solution:")[-1]
         try:
             pattern = r'\[(\d,\s*\d,\s*\d,\s*\d,\s*\d,\s*\d,\s*\d,\s*\d,\s*\d)\]'
@@ -35,23 +117,27 @@ class SudokuEndToEndPrompter(Prompter):
             for match in matches:
                 integer_list = [int(x.strip()) for x in match.split(',')]
                 result.append(integer_list)
-            if result == self.solution:
+            if result == context.solution:
                 return "1"
             return "0"
         except:
             return "parsing error"
 
+    def parse_answer(self, raw: str, context: SolutionContext) -> str:
+        return parse_grid(raw, "Solution:")
+
 
 class SudokuStateCheckingPrompter(Prompter):
-    def run(self, sample: Sample) -> str:
+    answer_pattern: str = r"Answer:\s*\([AB]\)"
+    def run(self, sample: Sample) -> Tuple[str, PromptContext]:
         instruction = "You are given a partially filled 9x9 Sudoku grid represented as a list of lists, where empty cells are represented as 0. Your task is to determine if this current state can lead to a solvable solution. Specifically, use lookahead techniques to determine if it's possible to fill the remaining cells according to standard Sudoku rules, ensuring that each row, column, and 3x3 subgrid contains unique numbers from 1 to 9."
         extra_information = "Additionally, you are provided with a previously explored next state that has been proven to be unsolvable. Use this information to avoid revisiting this failed path and leverage it to make a more informed decision about the current state."
         output_format = '''Let's think step by step, considering the failed state to avoid unnecessary exploration. Do not solve using programming.\nChoose from (A) Solvable (B) Unsolvable. End your answer with "Answer: (A)" or "Answer: (B)".'''
         current_state = sample.inputs["current"]
         unsolvable_child = sample.inputs["unsolvable_child"]
-        return f"{instruction}\n{extra_information}\nCurrent state:\n{current_state}\nExplored next state that leads to an unsolvable path:\n{unsolvable_child}\n{output_format}"
+        return f"{instruction}\n{extra_information}\nCurrent state:\n{current_state}\nExplored next state that leads to an unsolvable path:\n{unsolvable_child}\n{output_format}", PromptContext()
     
-    def get_answer(self, raw: str) -> str:
+    def get_answer(self, raw: str, context: PromptContext) -> str:
         letters = "AB"
         matches = re.findall(f"\(([{letters}])\)", raw)
         if matches:
@@ -74,11 +160,8 @@ class SudokuStateCheckingPrompter(Prompter):
 
 
 class SudokuStateTransitionPrompter(Prompter):
-    parent_state: list = []
-    current_state: list = []
-    unsolvable_child: list = []
-    current_status: str = ""
-    def run(self, sample: Sample) -> str:
+    answer_pattern: str = "Next state:"
+    def run(self, sample: Sample) -> Tuple[str, TransitionContext]:
         instruction = "You are given an initial Sudoku puzzle S(0), followed by a sequence of progressive states leading to the current state S(i). Alongside each state, its solvability status L(*) is given. Your task is to determine the next state by making exactly one move, ensuring progress toward a valid solution. A valid Sudoku solution requires that each row, column, and 3x3 subgrid contains the numbers 1 to 9 without repetition."
         move_definition = "**A move is defined as either:**\n"
         move_definition += "1. Filling: Replacing a 0 in exactly one empty cell with a value from 1 to 9.\n"
@@ -90,10 +173,12 @@ class SudokuStateTransitionPrompter(Prompter):
         current_state = sample.inputs["current"]
         current_status = sample.outputs["current_status"]
         unsolvable_child = sample.inputs["unsolvable_child"]
-        self.parent_state = parent_state
-        self.current_state = current_state
-        self.current_status = current_status
-        self.unsolvable_child = unsolvable_child
+        context = TransitionContext(
+            parent_state=parent_state,
+            current_state=current_state,
+            current_status=current_status,
+            unsolvable_child=unsolvable_child,
+        )
         output_format = '''Let's think step by step. Analyze the progress made so far and determine the immediate next move. End your answer with \"Next state: \{grid\}\", where \{grid\} is in the same python list format as the previous states.'''
         full_prompt = f"{instruction}\n"
         full_prompt += f"{extra_information}\n"
@@ -104,9 +189,9 @@ class SudokuStateTransitionPrompter(Prompter):
         full_prompt += f"**Current state:**\nS(i) = {current_state}\nL(i) = {current_status}\n"
         full_prompt += f"**Explored next state:**\nS(i+1) = {unsolvable_child}\nL(i+1) = Unsolvable\n"
         full_prompt += f"{output_format}"
-        return full_prompt
+        return full_prompt, context
 
-    def get_answer(self, raw: str) -> str:
+    def get_answer(self, raw: str, context: TransitionContext) -> str:
         raw = raw.split("Next state:")[-1]
         try:
             pattern = r'\[(\d,\s*\d,\s*\d,\s*\d,\s*\d,\s*\d,\s*\d,\s*\d,\s*\d)\]'
@@ -117,22 +202,22 @@ class SudokuStateTransitionPrompter(Prompter):
                 result.append(integer_list)
 
             # if the current state is unsolvable, the next state should be the parent state
-            if self.current_status == "Unsolvable":
-                if result == self.parent_state:
+            if context.current_status == "Unsolvable":
+                if result == context.parent_state:
                     return "1"
                 else:
-                    sudoku_tree = SudokuTree(self.parent_state)
-                    is_next_state = sudoku_tree.is_next_state(self.parent_state, result)
+                    sudoku_tree = SudokuTree(context.parent_state)
+                    is_next_state = sudoku_tree.is_next_state(context.parent_state, result)
                     if is_next_state == "1":
                         return "sibling"
                     return "backtracking failure"
 
             # if the current state is solvable, the next state should be the current state
             else:
-                sudoku_tree = SudokuTree(self.current_state)
-                is_next_state = sudoku_tree.is_next_state(self.current_state, result)
+                sudoku_tree = SudokuTree(context.current_state)
+                is_next_state = sudoku_tree.is_next_state(context.current_state, result)
                 if is_next_state == "1":
-                    if result != self.unsolvable_child:
+                    if result != context.unsolvable_child:
                         return "1"
                     else:
                         return "unsolvable child"
@@ -142,15 +227,16 @@ class SudokuStateTransitionPrompter(Prompter):
         except:
             return "parsing error"
 
+    def parse_answer(self, raw: str, context: TransitionContext) -> str:
+        return parse_grid(raw, "Next state:")
+
 
 class GraphColoringEndToEndPrompter(Prompter):
-    graph: list = []
-    chromatic_number: int = 0
-    def run(self, sample: Sample) -> str:
+    answer_pattern: str = "Solution:"
+    def run(self, sample: Sample) -> Tuple[str, GraphContext]:
         graph = sample.inputs["graph"]
         chromatic_number = sample.inputs["chromatic_number"]
-        self.graph = graph
-        self.chromatic_number = chromatic_number
+        context = GraphContext(graph=graph, chromatic_number=chromatic_number)
         initial_state = [0] * len(graph)
         input_format = "You are given a graph represented as an adjacency list, where each index corresponds to a vertex, and the list at that index represents its adjacent vertices. You are also given the initial coloring state of the graph in a list, where each index represents the corresonding vertex, and the number at that index represents its color (0 indicates an uncolored vertex)."
         instruction = f"Your task is to color the vertices such that no two adjacent vertices share the same color, using no more than {chromatic_number} colors in total."
@@ -160,9 +246,9 @@ class GraphColoringEndToEndPrompter(Prompter):
         full_prompt += f"Graph: {graph}\n"
         full_prompt += f"Initial Coloring: {initial_state}\n"
         full_prompt += f"{output_format}"
-        return full_prompt
+        return full_prompt, context
     
-    def get_answer(self, raw: str) -> str:
+    def get_answer(self, raw: str, context: GraphContext) -> str:
         raw = raw.split("Solution:")[-1]
         try:
             coloring = re.findall(r"\d+", raw)
@@ -170,17 +256,17 @@ class GraphColoringEndToEndPrompter(Prompter):
                 return "no coloring found"
 
             coloring = [int(x) for x in coloring]
-            if len(coloring) != len(self.graph):
+            if len(coloring) != len(context.graph):
                 return "invalid coloring"
 
             non_zero_colors = set()
             for color in coloring:
                 if color != 0:
                     non_zero_colors.add(color)
-            if len(non_zero_colors) > self.chromatic_number:
+            if len(non_zero_colors) > context.chromatic_number:
                 return "too many colors"
 
-            graph_coloring_tree = GraphColoringTree(self.graph, self.chromatic_number)
+            graph_coloring_tree = GraphColoringTree(context.graph, context.chromatic_number)
             if graph_coloring_tree.is_valid_coloring(coloring):
                 return "1"
             return "0"
@@ -188,9 +274,13 @@ class GraphColoringEndToEndPrompter(Prompter):
         except:
             return "parsing error"
 
+    def parse_answer(self, raw: str, context: GraphContext) -> str:
+        return parse_coloring(raw, "Solution:")
+
 
 class GraphColoringStateCheckingPrompter(Prompter):
-    def run(self, sample: Sample) -> str:
+    answer_pattern: str = r"Answer:\s*\([AB]\)"
+    def run(self, sample: Sample) -> Tuple[str, PromptContext]:
         graph = sample.inputs["graph"]
         chromatic_number = sample.inputs["chromatic_number"]
         current_state = sample.inputs["current"]
@@ -207,9 +297,9 @@ class GraphColoringStateCheckingPrompter(Prompter):
         full_prompt += f"**Current coloring state:**\n{current_state}\n"
         full_prompt += f"**Explored next state that leads to an uncolorable path:**\n{unsolvable_child}\n"
         full_prompt += f"{output_format}"
-        return full_prompt
+        return full_prompt, PromptContext()
 
-    def get_answer(self, raw: str) -> str:
+    def get_answer(self, raw: str, context: PromptContext) -> str:
         letters = "AB"
         matches = re.findall(f"\(([{letters}])\)", raw)
         if matches:
@@ -232,17 +322,10 @@ class GraphColoringStateCheckingPrompter(Prompter):
 
 
 class GraphColoringStateTransitionPrompter(Prompter):
-    graph: list = []
-    chromatic_number: int = 0
-    parent_state: list = []
-    current_state: list = []
-    unsolvable_child: list = []
-    current_status: str = ""
-    def run(self, sample: Sample) -> str:
+    answer_pattern: str = "Next state:"
+    def run(self, sample: Sample) -> Tuple[str, GraphColoringTransitionContext]:
         graph = sample.inputs["graph"]
         chromatic_number = sample.inputs["chromatic_number"]
-        self.graph = graph
-        self.chromatic_number = chromatic_number
         instruction = f"You are given a graph represented as an adjacency list, where each index corresponds to a vertex, and the list at that index represents its adjacent vertices. You are also given a sequence of partial coloring states leading to the current coloring state S(i). The coloring state is a list, where each index represents the corresonding vertex in the graph, and the number at that index represents its color (0 indicates an uncolored vertex). Alongside each state, its colorability status L(*) is given. Your task is to determine the next state by making exactly one move, ensuring progress toward a valid coloring with no more than {chromatic_number} colors. A valid coloring requires that no two adjacent vertices share the same color."
         extra_information = "Additionally, you are provided with a previously explored next state that has been proven to be uncolorable. Use this information to avoid revisiting this failed path."
         move_definition = "**A move is defined as either:**\n"
@@ -253,10 +336,14 @@ class GraphColoringStateTransitionPrompter(Prompter):
         current_state = sample.inputs["current"]
         current_status = "Colorable" if sample.outputs["current_status"] == "Solvable" else "Uncolorable"
         unsolvable_child = sample.inputs["unsolvable_child"]
-        self.parent_state = parent_state
-        self.current_state = current_state
-        self.current_status = current_status
-        self.unsolvable_child = unsolvable_child
+        context = GraphColoringTransitionContext(
+            graph=graph,
+            chromatic_number=chromatic_number,
+            parent_state=parent_state,
+            current_state=current_state,
+            current_status=current_status,
+            unsolvable_child=unsolvable_child,
+        )
         output_format = '''Let's think step by step. Analyze the progress made so far and determine the immediate next move. End your answer with \"Next state: \{coloring\}\", where \{coloring\} is in the same python list format as the previous states.'''
         full_prompt = f"{instruction}\n"
         full_prompt += f"{extra_information}\n"
@@ -267,61 +354,64 @@ class GraphColoringStateTransitionPrompter(Prompter):
         full_prompt += f"**Current coloring state:**\nS(i) = {current_state}\nL(i) = {current_status}\n"
         full_prompt += f"**Explored next state:**\nS(i+1) = {unsolvable_child}\nL(i+1) = Uncolorable\n"
         full_prompt += f"{output_format}"
-        return full_prompt
+        return full_prompt, context
 
-    def get_answer(self, raw: str) -> str:
+    def get_answer(self, raw: str, context: GraphColoringTransitionContext) -> str:
         raw = raw.split("Next state:")[-1]
         coloring = re.findall(r"\d+", raw)
         if not coloring:
             return "no coloring found"
 
         coloring = [int(x) for x in coloring]
-        if len(coloring) != len(self.graph):
+        if len(coloring) != len(context.graph):
             return "invalid coloring"
 
         non_zero_colors = set()
         for color in coloring:
             if color != 0:
                 non_zero_colors.add(color)
-        if len(non_zero_colors) > self.chromatic_number:
+        if len(non_zero_colors) > context.chromatic_number:
             return "too many colors"
 
-        graph_coloring_tree = GraphColoringTree(self.graph, self.chromatic_number)
-        if self.current_status == "Uncolorable":
-            if coloring == self.parent_state:
+        graph_coloring_tree = GraphColoringTree(context.graph, context.chromatic_number)
+        if context.current_status == "Uncolorable":
+            if coloring == context.parent_state:
                 return "1"
             else:
-                if graph_coloring_tree.is_next_state(self.parent_state, coloring) == "1":
+                if graph_coloring_tree.is_next_state(context.parent_state, coloring) == "1":
                     return "sibling"
                 else:
                     return "backtracking failure"
         else:
-            is_next_state = graph_coloring_tree.is_next_state(self.current_state, coloring)
+            is_next_state = graph_coloring_tree.is_next_state(context.current_state, coloring)
             if is_next_state == "1":
-                if coloring != self.unsolvable_child:
+                if coloring != context.unsolvable_child:
                     return "1"
                 else:
                     return "unsolvable child"
             else:
                 return is_next_state
 
+    def parse_answer(self, raw: str, context: GraphColoringTransitionContext) -> str:
+        return parse_coloring(raw, "Next state:")
+
 
 class Game24EndToEndPrompter(Prompter):
-    numbers: list = []
-    def run(self, sample: Sample) -> str:
+    answer_pattern: str = "Solution:"
+    def run(self, sample: Sample) -> Tuple[str, Game24Context]:
         initial_state = sample.inputs["initial_state"]
-        self.numbers = [int(num) for num in initial_state]
+        numbers = [int(num) for num in initial_state]
 
         input_format = "You are given four numbers for the Game of 24."
         instruction = f"Your task is to use basic arithmetic operations (+ - * /) to reach exactly 24. You must use each number exactly once."
         output_format = "Let's think step by step. Do not solve using programming.\nEnd your answer with \"Solution: expression\", e.g., \"Solution: 5 + 5 + 5 + 9 = 24\"."
         full_prompt = f"{input_format}\n"
         full_prompt += f"{instruction}\n"
-        full_prompt += f"Numbers: {self.numbers}\n"
+        full_prompt += f"Numbers: {numbers}\n"
         full_prompt += f"{output_format}"
-        return full_prompt
+        return full_prompt, Game24Context(numbers=numbers)
     
-    def get_answer(self, raw: str) -> str:
+    def get_answer(self, raw: str, context: Game24Context) -> str:
         raw = raw = raw.split("**Solution:**")[-1].split("Solution:")[-1]
         try:
             expression = (
@@ -330,17 +420,27 @@ class Game24EndToEndPrompter(Prompter):
             expression = expression.replace("\\(", "").replace("\\[", "").replace("\\{", "").replace("\\times", "*").replace("\\div", "/")
             numbers = re.findall(r"\d+", expression)
             numbers = [int(x) for x in numbers]
-            if sorted(numbers) != sorted(self.numbers):
+            if sorted(numbers) != sorted(context.numbers):
                 return "different numbers"
 
+            # sympy is slow to import, so only pay for it when an answer is checked
+            import sympy
+
             return str(int(sympy.simplify(expression) == 24))
             
         except Exception as e:
             return "parsing error"
 
+    def parse_answer(self, raw: str, context: Game24Context) -> str:
+        raw = raw.split("**Solution:**")[-1].split("Solution:")[-1]
+        expression = raw.strip().split("=")[0]
+        expression = expression.replace("\\(", "").replace("\\[", "").replace("\\{", "").replace("\\times", "*").replace("\\div", "/")
+        # Spacing does not change an expression
+        return re.sub(r"\s+", "", expression) if re.search(r"\d", expression) else ""
+
 
 class Game24StateCheckingPrompter(SudokuStateCheckingPrompter):
-    def run(self, sample: Sample) -> str:
+    def run(self, sample: Sample) -> Tuple[str, PromptContext]:
         numbers = sample.inputs["initial_state"]
         current_state = sample.inputs["current"]
         unsolvable_child = sample.inputs["unsolvable_child"]
@@ -356,27 +456,25 @@ class Game24StateCheckingPrompter(SudokuStateCheckingPrompter):
         full_prompt += f"**Current calculation state:**\n{current_state}\n"
         full_prompt += f"**Explored next state that leads to an unsolvable path:**\n{unsolvable_child}\n"
         full_prompt += f"{output_format}"
-        return full_prompt
+        return full_prompt, PromptContext()
 
 
 class Game24StateTransitionPrompter(Prompter):
-    parent_state: list = []
-    current_state: list = []
-    unsolvable_child: list = []
-    current_status: str = ""
-    numbers: list = []
-    def run(self, sample: Sample) -> str:
+    answer_pattern: str = "Next state:"
+    def run(self, sample: Sample) -> Tuple[str, Game24TransitionContext]:
         initial_state = sample.inputs["initial_state"]
         grandparent_state = sample.inputs["grandparent"]
         parent_state = sample.inputs["parent"]
         current_state = sample.inputs["current"]
         current_status = sample.outputs["current_status"]
         unsolvable_child = sample.inputs["unsolvable_child"]
-        self.parent_state = parent_state
-        self.current_state = current_state
-        self.current_status = current_status
-        self.unsolvable_child = unsolvable_child
-        self.numbers = [int(num) for num in initial_state]
+        context = Game24TransitionContext(
+            parent_state=parent_state,
+            current_state=current_state,
+            current_status=current_status,
+            unsolvable_child=unsolvable_child,
+            numbers=[int(num) for num in initial_state],
+        )
 
         instruction = "You are given an initial Game of 24 configuration S(0), followed by a sequence of progressive states leading to the current state S(i). Alongside each state, its solvability status L(*) is given. Your task is to determine the next state by making exactly one move, ensuring progress toward a valid solution. A valid solution requires using each of the four initial numbers exactly once, using only basic arithmetic operations (+ - * /), and ultimately evaluating to 24."
         extra_information = "Additionally, you are provided with a previously explored next state that has been proven to be unsolvable. Use this information to avoid revisiting this failed path."
@@ -393,9 +491,9 @@ class Game24StateTransitionPrompter(Prompter):
         full_prompt += f"**Current state:**\nS(i) = {current_state}\nL(i) = {current_status}\n"
         full_prompt += f"**Explored next state:**\nS(i+1) = {unsolvable_child}\nL(i+1) = Unsolvable\n"
         full_prompt += f"{output_format}"
-        return full_prompt
+        return full_prompt, context
 
-    def get_answer(self, raw: str) -> str:
+    def get_answer(self, raw: str, context: Game24TransitionContext) -> str:
         raw = raw.split("Next state:")[-1]
         try:
             pattern = r"\[[^\]]*\]"
@@ -406,21 +504,21 @@ class Game24StateTransitionPrompter(Prompter):
             for expression in result:
                 numbers.extend(re.findall(r"\d+", expression))
             numbers = [int(num) for num in numbers]
-            if sorted(numbers) != sorted(self.numbers):
+            if sorted(numbers) != sorted(context.numbers):
                 return "different numbers"
 
-            game24_tree = GameOf24Tree(self.numbers)
-            if self.current_status == "Unsolvable":
-                if result == self.parent_state:
+            game24_tree = GameOf24Tree(context.numbers)
+            if context.current_status == "Unsolvable":
+                if result == context.parent_state:
                     return "1"
                 else:
-                    if game24_tree.is_next_state(self.parent_state, result) == "1":
+                    if game24_tree.is_next_state(context.parent_state, result) == "1":
                         return "sibling"
                     return "backtracking failure"
             else:
-                is_next_state = game24_tree.is_next_state(self.current_state, result)
+                is_next_state = game24_tree.is_next_state(context.current_state, result)
                 if is_next_state == "1":
-                    if result != self.unsolvable_child:
+                    if result != context.unsolvable_child:
                         return "1"
                     else:
                         return "unsolvable child"
@@ -429,10 +527,17 @@ class Game24StateTransitionPrompter(Prompter):
         except:
             return "parsing error"
 
+    def parse_answer(self, raw: str, context: Game24TransitionContext) -> str:
+        try:
+            result = ast.literal_eval(re.findall(r"\[[^\]]*\]", raw.split("Next state:")[-1])[-1])
+            return str([re.sub(r"\s+", "", expression) for expression in result])
+        except:
+            return ""
+
 
 class GridPuzzleEndToEndPrompter(Prompter):
-    solution: list = []
-    def run(self, sample: Sample) -> str:
+    answer_pattern: str = "Solution:"
+    def run(self, sample: Sample) -> Tuple[str, SolutionContext]:
         question = sample.inputs["question"]
         categories = sample.inputs["categories"]
         clues = sample.inputs["clues"]
@@ -442,7 +547,7 @@ class GridPuzzleEndToEndPrompter(Prompter):
             text_clues.append(f"{num}. {text}")
         initial_state = sample.inputs["initial"]
         solution = sample.outputs["solution"]
-        self.solution = solution
+        context = SolutionContext(solution=solution)
 
         input_format = "You are given a logic grid puzzle represented as a table, where each column corresponds to a specific category, and each row represents attributes of a distinct entry. Empty cells are represented as the empty string ('')."
         instruction = "Your task is to assign the attributes from categories based on the clues."
@@ -456,25 +561,28 @@ class GridPuzzleEndToEndPrompter(Prompter):
             full_prompt += f"{text}\n"
         full_prompt += f"Initial Table:\n{initial_state}\n"
         full_prompt += f"{output_format}"
-        return full_prompt
+        return full_prompt, context
 
-    def get_answer(self, raw: str) -> str:
+    def get_answer(self, raw: str, context: SolutionContext) -> str:
         raw = raw.split("Solution:")[-1]
         raw = raw.replace("\n", "")
         try:
             pattern = r"\[\s*\[.*?\]\s*\]"
             match = re.findall(pattern, raw, re.DOTALL)[-1]
             result = ast.literal_eval(match)
-            if result == self.solution:
+            if result == context.solution:
                 return "1"
             else:
                 return "0"
         except:
             return "parsing error"
 
+    def parse_answer(self, raw: str, context: SolutionContext) -> str:
+        return parse_table(raw, "Solution:")
+
 
 class GridPuzzleStateCheckingPrompter(SudokuStateCheckingPrompter):
-    def run(self, sample: Sample) -> str:
+    def run(self, sample: Sample) -> Tuple[str, PromptContext]:
         question = sample.inputs["question"]
         categories = sample.inputs["categories"]
         clues = sample.inputs["clues"]
@@ -515,20 +623,13 @@ class GridPuzzleStateCheckingPrompter(SudokuStateCheckingPrompter):
         full_prompt += f"Clue applied: {clue_applied_to_unsolvable_child}\n"
         full_prompt += f"S({i+2}) = {unsolvable_child}\n"
         full_prompt += f"{output_format}"
-        return full_prompt
+        return full_prompt, PromptContext()
 
 
 class GridPuzzleStateTransitionPrompter(Prompter):
-    initial_state: list = []
-    parent_state: list = []
-    current_state: list = []
-    unsolvable_child: list = []
-    current_status: str = ""
-    applied_clues: list = []
-    all_clues: dict = {}
-    domain: dict = {}
-
-    def run(self, sample: Sample) -> str:
+    answer_pattern: str = "Next state:"
+
+    def run(self, sample: Sample) -> Tuple[str, GridPuzzleTransitionContext]:
         question = sample.inputs["question"]
         categories = sample.inputs["categories"]
         clues = sample.inputs["clues"]
@@ -553,14 +654,16 @@ class GridPuzzleStateTransitionPrompter(Prompter):
                 unique_values.add(row[col_index])
             domains[column_name] = sorted(unique_values)
 
-        self.initial_state = initial_state
-        self.parent_state = parent_state
-        self.current_state = current_state
-        self.current_status = current_status
-        self.unsolvable_child = unsolvable_child
-        self.applied_clues = applied_clues
-        self.all_clues = clues
-        self.domain = domains
+        context = GridPuzzleTransitionContext(
+            initial_state=initial_state,
+            parent_state=parent_state,
+            current_state=current_state,
+            current_status=current_status,
+            unsolvable_child=unsolvable_child,
+            applied_clues=applied_clues,
+            all_clues=clues,
+            domain=domains,
+        )
 
         instruction = "You are given a logic grid puzzle represented as a table, where each column corresponds to a specific category, and each row represents attributes of a distinct entry. Empty cells are represented as the empty string (''). You are also given a sequence of progressive states from the initial state S(0) to the current state S(n). Alongside each state, its solvability status L(*) is provided. Your task is to determine the next state by making exactly one move, ensuring progress toward a valid solution. A valid solution requires that each option in every category appears only once, strictly following the given clues."
         extra_information = "Additionally, you are provided with a previously explored next state that has been proven to be unsolvable. Use this information to avoid revisiting this failed path."
@@ -591,9 +694,9 @@ class GridPuzzleStateTransitionPrompter(Prompter):
         full_prompt += f"Clue applied: {clue_applied_to_unsolvable_child}\n"
         full_prompt += f"S({i+2}) = {unsolvable_child}\nL({i+2}) = Unsolvable\n"
         full_prompt += f"{output_format}"
-        return full_prompt
+        return full_prompt, context
 
-    def get_answer(self, raw: str) -> str:
+    def get_answer(self, raw: str, context: GridPuzzleTransitionContext) -> str:
         raw = raw.split("Next state:")[-1]
         raw = raw.replace("\n", "")
         try:
@@ -602,23 +705,23 @@ class GridPuzzleStateTransitionPrompter(Prompter):
             result = ast.literal_eval(match)
 
             all_conditions = []
-            for num, value in self.all_clues.items():
+            for num, value in context.all_clues.items():
                 all_conditions.append(value["conditions"])
-            puzzle = LogicGridPuzzleTree(self.initial_state, self.domain, all_conditions)
+            puzzle = LogicGridPuzzleTree(context.initial_state, context.domain, all_conditions)
             
-            if self.current_status == "Unsolvable":
-                if result == self.parent_state:
+            if context.current_status == "Unsolvable":
+                if result == context.parent_state:
                     return "1"
                 else:
-                    applied_clues = self.applied_clues[:-1]
-                    unapplied_clues = [self.all_clues[num]["conditions"] for num in self.all_clues if num not in applied_clues]
-                    if puzzle.is_next_state(self.parent_state, result, unapplied_clues):
+                    applied_clues = context.applied_clues[:-1]
+                    unapplied_clues = [context.all_clues[num]["conditions"] for num in context.all_clues if num not in applied_clues]
+                    if puzzle.is_next_state(context.parent_state, result, unapplied_clues):
                         return "sibling"
                     return "backtracking failure"
             else:
-                unapplied_clues = [self.all_clues[num]["conditions"] for num in self.all_clues if num not in self.applied_clues]
-                if puzzle.is_next_state(self.current_state, result, unapplied_clues):
-                    if result != self.unsolvable_child:
+                unapplied_clues = [context.all_clues[num]["conditions"] for num in context.all_clues if num not in context.applied_clues]
+                if puzzle.is_next_state(context.current_state, result, unapplied_clues):
+                    if result != context.unsolvable_child:
                         return "1"
                     else:
                         return "unsolvable child"
@@ -628,6 +731,9 @@ class GridPuzzleStateTransitionPrompter(Prompter):
         except:
             return "parsing error"
 
+    def parse_answer(self, raw: str, context: GridPuzzleTransitionContext) -> str:
+        return parse_table(raw, "Next state:")
+
 
 def select_prompter(name: str) -> Prompter:
     if name == "sudoku_e2e":
@@ -662,7 +768,8 @@ def test_prompter(data_name: str, prompter_name: str):
     data = select_data(data_name)
     prompter = select_prompter(prompter_name)
     sample = data.samples[0]
-    print(prompter.run(sample))
+    prompt, context = prompter.run(sample)
+    print(prompt)
 
 
 if __name__ == "__main__":
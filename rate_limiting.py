@@ -0,0 +1,167 @@
+import asyncio
+import random
+import sys
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+# Request timeouts, conflicts, rate limits and server errors are worth retrying, other client errors are not
+RETRYABLE_STATUS_CODES = {408, 409, 429}
+# Connection failures and timeouts of the backend clients, which carry no status code
+TRANSPORT_ERRORS = [
+    ("openai", "APIConnectionError"),
+    ("httpx", "TransportError"),
+    ("google.api_core.exceptions", "GoogleAPIError"),
+]
+
+
+class RequestError(Exception):
+    """
+    Raised when a request failed permanently or ran out of attempts.
+    """
+
+
+class TokenBucket:
+    """
+    Budget of `per_minute` units that refills continuously. Reservations are taken immediately, even past
+    an empty bucket, and the caller is told how long to wait, so waiting callers are served in turn.
+    """
+
+    def __init__(self, per_minute: float):
+        self.rate = per_minute / 60
+        self.capacity = per_minute
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def reserve(self, amount: float, now: float) -> float:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        self.level -= amount
+        return max(-self.level / self.rate, 0.0)
+
+    def get_wait(self, amount: float, now: float) -> float:
+        # Same as reserve, without taking anything
+        level = min(self.capacity, self.level + (now - self.updated) * self.rate) - amount
+        return max(-level / self.rate, 0.0)
+
+
+class RateLimiter:
+    """
+    Shared requests-per-minute and tokens-per-minute budgets (0 disables either), plus a pause that
+    holds back every caller after the API asks for one with Retry-After. Safe to share across threads.
+    """
+
+    def __init__(self, requests_per_minute: float = 0, tokens_per_minute: float = 0):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute > 0 else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute > 0 else None
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def reserve(self, tokens: float = 0) -> float:
+        """
+        Take one request and the given tokens from the budgets, and return the seconds to wait before sending.
+        """
+        with self.lock:
+            now = time.monotonic()
+            wait = self.paused_until - now
+            if self.requests is not None:
+                wait = max(wait, self.requests.reserve(1, now))
+            if self.tokens is not None:
+                wait = max(wait, self.tokens.reserve(tokens, now))
+        return max(wait, 0.0)
+
+    def get_wait(self, tokens: float = 0) -> float:
+        """
+        Return the seconds a request with the given tokens would wait if it were reserved now.
+        """
+        with self.lock:
+            now = time.monotonic()
+            wait = self.paused_until - now
+            if self.requests is not None:
+                wait = max(wait, self.requests.get_wait(1, now))
+            if self.tokens is not None:
+                wait = max(wait, self.tokens.get_wait(tokens, now))
+        return max(wait, 0.0)
+
+    def is_paused(self) -> bool:
+        with self.lock:
+            return self.paused_until > time.monotonic()
+
+    def record(self, tokens: float):
+        """
+        Correct the token budget once a response reports more (or fewer) tokens than were reserved.
+        """
+        if self.tokens is not None:
+            with self.lock:
+                self.tokens.reserve(tokens, time.monotonic())
+
+    def pause(self, seconds: float):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+rate_limiters: Dict[Tuple, RateLimiter] = {}
+rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(key: str, requests_per_minute: float = 0, tokens_per_minute: float = 0) -> RateLimiter:
+    """
+    Return the limiter for a quota, so every model instance drawing on the same quota shares one budget.
+    """
+    with rate_limiters_lock:
+        full_key = (key, requests_per_minute, tokens_per_minute)
+        if full_key not in rate_limiters:
+            rate_limiters[full_key] = RateLimiter(requests_per_minute, tokens_per_minute)
+        return rate_limiters[full_key]
+
+
+def get_status_code(error: Exception) -> Optional[int]:
+    # OpenAI errors carry status_code, Google API errors carry code
+    for name in ["status_code", "code"]:
+        code = getattr(error, name, None)
+        if isinstance(code, int):
+            return int(code)
+    return None
+
+
+def is_transport_error(error: Exception) -> bool:
+    """
+    Whether an error is a connection failure or timeout. Backend libraries are optional, so only the error
+    types of those already imported are checked.
+    """
+    if isinstance(error, (ConnectionError, TimeoutError, asyncio.TimeoutError)):
+        return True
+    for module_name, class_name in TRANSPORT_ERRORS:
+        error_class = getattr(sys.modules.get(module_name), class_name, None)
+        if error_class is not None and isinstance(error, error_class):
+            return True
+    return False
+
+
+def is_retryable(error: Exception) -> bool:
+    code = get_status_code(error)
+    if code is None:
+        return is_transport_error(error)
+    return code in RETRYABLE_STATUS_CODES or code >= 500
+
+
+def get_retry_after(error: Exception) -> float:
+    """
+    Seconds the API asked to wait before retrying, or 0 if it did not say.
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        return float(headers.get("retry-after", 0))
+    except ValueError:
+        # Retry-After can also be an HTTP date, which is treated as unspecified
+        return 0.0
+
+
+def get_backoff(attempt: int, base: float = 1.0, maximum: float = 60.0) -> float:
+    """
+    Exponential backoff with full jitter, so clients that failed together do not retry together.
+    """
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
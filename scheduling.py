@@ -0,0 +1,40 @@
+from glob import glob
+from typing import Dict, List
+
+from data_loading import Sample, iter_completed
+from prompting import Prompter
+
+
+def load_latencies(paths: List[str]) -> Dict[str, float]:
+    """
+    Average the model latency recorded for each input fingerprint across previous output files.
+    """
+    totals, counts = {}, {}
+    for path in paths:
+        for sample in iter_completed(path):
+            if sample.latency > 0:
+                key = sample.fingerprint()
+                totals[key] = totals.get(key, 0.0) + sample.latency
+                counts[key] = counts.get(key, 0) + 1
+    return {key: totals[key] / counts[key] for key in totals}
+
+
+def estimate_costs(samples: List[Sample], prompter: Prompter, latencies: Dict[str, float]) -> List[float]:
+    """
+    Predict the latency of each sample from earlier runs, falling back to its prompt length
+    scaled by the seconds per prompt character observed in those runs.
+    """
+    keys = [sample.fingerprint() for sample in samples]
+    lengths = [len(prompter.run(sample)[0]) for sample in samples]
+    known = [(latencies[key], length) for key, length in zip(keys, lengths) if key in latencies]
+    rate = sum(latency for latency, _ in known) / max(sum(length for _, length in known), 1) if known else 1.0
+    return [latencies.get(key, length * rate) for key, length in zip(keys, lengths)]
+
+
+def order_by_cost(samples: List[Sample], prompter: Prompter, history_pattern: str = "") -> List[int]:
+    """
+    Return sample positions with the most expensive first, so slow samples do not end up in the tail of a run.
+    """
+    latencies = load_latencies(sorted(glob(history_pattern))) if history_pattern else {}
+    costs = estimate_costs(samples, prompter, latencies)
+    return sorted(range(len(samples)), key=lambda i: -costs[i])
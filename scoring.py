@@ -7,6 +7,12 @@ class Scorer(BaseModel):
     def run(self, sample: Sample) -> float:
         raise NotImplementedError
 
+    def pass_at_k(self, sample: Sample) -> float:
+        # Whether any of the sample's completions is correct, which is pass@k with k completions
+        if not sample.preds:
+            return self.run(sample)
+        return max(self.run(sample.model_copy(update=dict(pred=pred))) for pred in sample.preds)
+
 
 class StateTransitionAccuracyScorer(Scorer):
     def run(self, sample: Sample) -> float:
@@ -0,0 +1,166 @@
+import http.client
+import inspect
+import json
+import os
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from typing import Callable, Dict
+from fire import Fire
+
+from data_loading import Data, Sample, select_data
+from main import run_evaluation
+from modeling import EvalModel, select_model
+
+
+class EvalServer:
+    """
+    Keeps models and datasets loaded across evaluation jobs, so a job only pays for its own samples.
+    """
+
+    def __init__(self):
+        self.models: Dict[str, EvalModel] = {}
+        self.datasets: Dict[str, Data] = {}
+        self.jobs = 0
+        self.lock = threading.Lock()
+
+    def get_model(self, model_name: str, **kwargs) -> EvalModel:
+        key = json.dumps(dict(model_name=model_name, **kwargs), sort_keys=True)
+        with self.lock:
+            if key not in self.models:
+                self.models[key] = select_model(model_name, **kwargs)
+            return self.models[key]
+
+    def get_data(self, data_name: str) -> Data:
+        with self.lock:
+            if data_name not in self.datasets:
+                self.datasets[data_name] = select_data(data_name)
+            return self.datasets[data_name]
+
+    def run(self, job: dict, on_result: Callable[[Sample, float], None]) -> dict:
+        # Options of run_evaluation configure the run, everything else configures the model like in evaluate
+        job = dict(job)
+        data_name = job.pop("data_name")
+        prompter_name = job.pop("prompter_name")
+        model_name = job.pop("model_name")
+        parameters = inspect.signature(run_evaluation).parameters
+        options = {key: job.pop(key) for key in list(job) if key in parameters}
+
+        data = self.get_data(data_name)
+        model = self.get_model(model_name, **job)
+        with self.lock:
+            self.jobs += 1
+        try:
+            return run_evaluation(data, model, data_name, prompter_name, model_name, on_result=on_result, **options)
+        finally:
+            with self.lock:
+                self.jobs -= 1
+
+    def status(self) -> dict:
+        with self.lock:
+            return dict(models=list(self.models), datasets=list(self.datasets), jobs=self.jobs)
+
+
+class EvalRequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /evaluate with a json job streams back one json line per finished sample, then a summary line.
+    GET /status lists the loaded models and datasets and the number of running jobs.
+    """
+
+    connected = True
+
+    def address_string(self) -> str:
+        # Unix socket clients have no address
+        return str(self.client_address[0]) if self.client_address else "unix"
+
+    def write_line(self, info: dict):
+        if not self.connected:
+            return
+        try:
+            self.wfile.write((json.dumps(info) + "\n").encode())
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # The job keeps running and its results still go to the output file
+            self.connected = False
+
+    def do_GET(self):
+        if self.path != "/status":
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.write_line(self.server.eval_server.status())
+
+    def do_POST(self):
+        if self.path != "/evaluate":
+            self.send_error(404)
+            return
+        job = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+
+        on_result = lambda sample, is_correct: self.write_line(dict(sample=sample.model_dump(), is_correct=is_correct))
+        try:
+            summary = self.server.eval_server.run(job, on_result)
+            self.write_line(dict(done=True, **summary))
+        except Exception as e:
+            self.write_line(dict(error=repr(e)))
+
+
+class UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path: str, **kwargs):
+        super().__init__("localhost", **kwargs)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+def serve(host: str = "127.0.0.1", port: int = 8765, socket_path: str = ""):
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        server = UnixHTTPServer(socket_path, EvalRequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), EvalRequestHandler)
+    server.eval_server = EvalServer()
+    print(f"Serving evaluation jobs on {socket_path or f'http://{host}:{port}'}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def submit(
+    data_name: str,
+    prompter_name: str,
+    model_name: str,
+    host: str = "127.0.0.1",
+    port: int = 8765,
+    socket_path: str = "",
+    **kwargs,
+):
+    job = dict(data_name=data_name, prompter_name=prompter_name, model_name=model_name, **kwargs)
+    if socket_path:
+        connection = UnixHTTPConnection(socket_path)
+    else:
+        connection = http.client.HTTPConnection(host, port)
+    connection.request("POST", "/evaluate", body=json.dumps(job), headers={"Content-Type": "application/json"})
+    response = connection.getresponse()
+    for line in response:
+        info = json.loads(line)
+        print(json.dumps(info, indent=2))
+        if "error" in info:
+            raise RuntimeError(info["error"])
+
+
+if __name__ == "__main__":
+    Fire()
@@ -0,0 +1,129 @@
+import asyncio
+import contextvars
+import os
+import queue
+import re
+import threading
+import time
+from pathlib import Path
+from typing import AsyncIterator, Callable, Iterator, Optional, Tuple
+
+
+class StreamRecorder:
+    """
+    Collects a streamed completion, appending each piece to a partial file as it arrives so that a completion
+    cut off by a timeout or crash is kept on disk, and measures time to first token and tokens per second.
+    """
+
+    def __init__(self, path: str, stop_pattern: str = ""):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.stop_pattern = stop_pattern
+        self.file = open(path, "w")
+        self.pieces = []
+        self.tail = ""
+        self.answered = False
+        self.start = time.time()
+        self.first = None
+        self.tokens = None
+
+    @property
+    def text(self) -> str:
+        return "".join(self.pieces)
+
+    def add(self, piece: str, tokens: Optional[int] = None):
+        if tokens is not None:
+            self.tokens = tokens
+        if not piece:
+            return
+        if self.first is None:
+            self.first = time.time()
+        self.pieces.append(piece)
+        self.file.write(piece)
+        self.file.flush()
+        if self.stop_pattern and not self.answered:
+            # Only the end of the text can complete a match, as earlier text was already searched
+            self.tail = (self.tail + piece)[-1000:]
+            self.answered = re.search(self.stop_pattern, self.tail) is not None
+
+    def get_stats(self) -> dict:
+        if self.first is None:
+            return dict(ttft=0.0, tokens_per_second=0.0)
+        duration = time.time() - self.first
+        # Without a token count from the API, each streamed piece is counted as a token
+        tokens = self.tokens or len(self.pieces)
+        return dict(ttft=self.first - self.start, tokens_per_second=tokens / duration if duration > 0 else 0.0)
+
+    def close(self, keep: bool = False):
+        self.file.close()
+        if not keep:
+            os.remove(self.path)
+
+
+def read_stream(
+    chunks: Iterator[Tuple[str, Optional[int]]],
+    recorder: StreamRecorder,
+    stop_idle: float = 0.0,
+    close: Callable[[], None] = lambda: None,
+) -> str:
+    """
+    Read (text, completion tokens) chunks into the recorder and return the text. With stop_idle, the stream is
+    dropped once the recorder has seen the answer and no chunk arrived for stop_idle seconds. If the stream
+    breaks after the answer was seen, the text so far is returned instead of raising.
+    """
+    items = queue.Queue()
+
+    def produce():
+        # Chunks are read on their own thread, so waiting for the next one can time out
+        try:
+            for item in chunks:
+                items.put(item)
+            items.put(None)
+        except Exception as e:
+            items.put(e)
+
+    # The thread runs in a copy of the caller's context, so usage read from the chunks reaches the caller's stats
+    threading.Thread(target=contextvars.copy_context().run, args=(produce,), daemon=True).start()
+    while True:
+        try:
+            item = items.get(timeout=stop_idle if stop_idle > 0 and recorder.answered else None)
+        except queue.Empty:
+            close()
+            break
+        if item is None:
+            break
+        if isinstance(item, Exception):
+            if recorder.answered:
+                break
+            raise item
+        recorder.add(*item)
+    return recorder.text
+
+
+async def aread_stream(
+    chunks: AsyncIterator[Tuple[str, Optional[int]]], recorder: StreamRecorder, stop_idle: float = 0.0
+) -> str:
+    """
+    Async version of read_stream.
+    """
+    iterator = chunks.__aiter__()
+    while True:
+        try:
+            timeout = stop_idle if stop_idle > 0 and recorder.answered else None
+            item = await asyncio.wait_for(iterator.__anext__(), timeout)
+        except StopAsyncIteration:
+            break
+        except asyncio.TimeoutError:
+            if hasattr(iterator, "aclose"):
+                try:
+                    await iterator.aclose()
+                except Exception:
+                    # The generator was interrupted mid-chunk, closing it only frees the connection
+                    pass
+            break
+        except Exception:
+            if recorder.answered:
+                break
+            raise
+        recorder.add(*item)
+    return recorder.text
@@ -0,0 +1,111 @@
+import os
+import socket
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Iterator, List, Set
+
+
+class WorkQueue:
+    """
+    A work queue of sample indices shared through a (possibly NFS-mounted) folder, using only the filesystem.
+    Workers lease an index by creating leases/{index} exclusively and mark it done by creating done/{index}.
+    Leases are renewed while held, and a lease that has not been renewed for lease_timeout seconds is
+    taken over by the next worker, so samples held by a crashed worker are redone (at least once delivery).
+    """
+
+    def __init__(self, folder: str, size: int, lease_timeout: float = 600.0):
+        self.folder = Path(folder)
+        self.size = size
+        self.lease_timeout = lease_timeout
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}"
+        self.held: Set[int] = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        (self.folder / "leases").mkdir(parents=True, exist_ok=True)
+        (self.folder / "done").mkdir(parents=True, exist_ok=True)
+        (self.folder / "results").mkdir(parents=True, exist_ok=True)
+
+    def lease_path(self, index: int) -> Path:
+        return self.folder / "leases" / str(index)
+
+    def done_path(self, index: int) -> Path:
+        return self.folder / "done" / str(index)
+
+    def remaining(self) -> List[int]:
+        done = set(os.listdir(self.folder / "done"))
+        return [i for i in range(self.size) if str(i) not in done]
+
+    def try_create(self, path: Path) -> bool:
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        os.write(fd, self.worker_id.encode())
+        os.close(fd)
+        return True
+
+    def acquire(self, index: int) -> bool:
+        path = self.lease_path(index)
+        if self.try_create(path):
+            return True
+
+        try:
+            expired = time.time() - path.stat().st_mtime > self.lease_timeout
+        except FileNotFoundError:
+            expired = True
+        if not expired:
+            return False
+
+        # Move the stale lease out of the way first, rename is atomic so only one worker wins the race
+        expired_path = path.with_name(f".expired-{index}-{uuid.uuid4().hex}")
+        try:
+            os.rename(path, expired_path)
+            expired_path.unlink()
+        except FileNotFoundError:
+            pass
+        return self.try_create(path)
+
+    def lease(self, indices: List[int]) -> Iterator[int]:
+        """
+        Lazily lease the given indices, skipping those done or held by another worker.
+        """
+        for index in indices:
+            if self.done_path(index).exists() or not self.acquire(index):
+                continue
+            if self.done_path(index).exists():
+                self.release(index)
+                continue
+            with self.lock:
+                self.held.add(index)
+            yield index
+
+    def release(self, index: int):
+        with self.lock:
+            self.held.discard(index)
+        self.lease_path(index).unlink(missing_ok=True)
+
+    def mark_done(self, index: int):
+        self.done_path(index).touch()
+        self.release(index)
+
+    def renew(self):
+        while not self.stopped.wait(self.lease_timeout / 4):
+            with self.lock:
+                held = list(self.held)
+            for index in held:
+                try:
+                    os.utime(self.lease_path(index))
+                except FileNotFoundError:
+                    pass
+
+    def __enter__(self):
+        self.stopped.clear()
+        threading.Thread(target=self.renew, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+        for index in list(self.held):
+            self.release(index)